@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tracemalloc
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import sync_page
+import sync_file
+import wikitext
+from fake_wiki import FakeWiki, FakeWikiServer, timestamp
+
+
+# end-to-end throughput of WikiSync against two local fake wikis
+
+
+def make_text(rnd, size):
+    words = [ "".join(rnd.choice("ABCDEFGHIJ あいうえお") for _ in range(8)) for _ in range(0, 50) ]
+    lines = ["{{h0|標題}}", "== 內容 =="]
+    length = 0
+    while length < size:
+        if len(lines) % 10 == 0:
+            lines.append("== 段落 {} ==".format(len(lines) // 10))
+        line = " ".join(rnd.choice(words) for _ in range(0, 10))
+        lines.append(line)
+        length += len(line)
+    return "\n".join(lines)
+
+
+def random_bytes(rnd, size):
+    # rnd.randbytes() needs python 3.9
+    return bytes(rnd.getrandbits(8) for _ in range(0, size))
+
+
+def make_wikis(args):
+    # "reko" has every page, "fandom" misses some and has a newer, different copy of others
+    rnd = random.Random(args.seed)
+    reko = FakeWiki("reko", args.latency, args.rate_limit, args.error_rate, args.captcha, seed=1)
+    fandom = FakeWiki("fandom", args.latency, args.rate_limit, args.error_rate, args.captcha, seed=2)
+    old = timestamp(time.time() - 7200)
+    new = timestamp(time.time() - 3600)
+    titles = []
+    for idx in range(0, args.pages):
+        title = "頁面 {}".format(idx)
+        titles.append(title)
+        text = make_text(rnd, args.page_size)
+        reko.add_page(title, text, ts=old)
+        dice = rnd.random()
+        if dice < args.missing:
+            continue
+        if dice < args.missing + args.diff:
+            fandom.add_page(title, text + "\n新增內容 {}".format(idx), ts=new)
+        else:
+            fandom.add_page(title, text, ts=old)
+    files = []
+    for idx in range(0, args.files):
+        title = "檔案:File {}.png".format(idx)
+        files.append(title)
+        data = random_bytes(rnd, args.file_size)
+        reko.add_file(title, data, ts=old)
+        dice = rnd.random()
+        if dice < args.missing:
+            continue
+        if dice < args.missing + args.diff:
+            fandom.add_file(title, random_bytes(rnd, args.file_size), ts=new)
+        else:
+            fandom.add_file(title, data, ts=old)
+    return reko, fandom, titles, files
+
+
+def count_diverged(source, target, titles):
+    # pages whose text on the target differs from the source, apart from the sync templates
+    diverged = 0
+    for title in titles:
+        old, new = source.latest(title), target.latest(title)
+        if new is None or wikitext.normalize(wikitext.clean(old["*"], False)) != wikitext.normalize(wikitext.clean(new["*"], False)):
+            diverged += 1
+    return diverged
+
+
+def serve_wikis(args, conn):
+    # run the fake wikis in a child process, so their memory is not counted as memory of the sync client,
+    # then answer the commands of the benchmark: ("reset" | "stats" | "diverged" | "stop", value)
+    reko, fandom, titles, files = make_wikis(args)
+    reko.max_upload = fandom.max_upload = args.max_upload
+    reko.section_conflict = fandom.section_conflict = args.section_conflict
+    with FakeWikiServer(reko) as reko_server, FakeWikiServer(fandom) as fandom_server:
+        conn.send(({ "reko": reko_server.info(), "fandom": fandom_server.info() }, titles, files))
+        while True:
+            command, value = conn.recv()
+            if command == "reset":
+                for wiki in [reko, fandom]:
+                    wiki.stats = { "requests": 0, "bytes_in": 0, "bytes_out": 0, "errors": 0, "actions": {} }
+                conn.send(None)
+            elif command == "stats":
+                conn.send([ (wiki.name, wiki.stats) for wiki in [reko, fandom] ])
+            elif command == "diverged":
+                conn.send(count_diverged(reko, fandom, value))
+            else:
+                conn.send(None)
+                break
+
+
+def call(conn, command, value=None):
+    conn.send((command, value))
+    return conn.recv()
+
+
+def run(name, func, count, conn):
+    call(conn, "reset")
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    spent = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats = call(conn, "stats")
+    requests = sum(en[1]["requests"] for en in stats)
+    bytes_in = sum(en[1]["bytes_in"] for en in stats)
+    bytes_out = sum(en[1]["bytes_out"] for en in stats)
+    errors = sum(en[1]["errors"] for en in stats)
+    print("{}: {} titles in {:.2f} s".format(name, count, spent))
+    print("    titles/sec        {:10.2f}".format(count / spent if spent > 0 else 0))
+    print("    requests          {:10d} ({:.2f} per title)".format(requests, requests / max(1, count)))
+    print("    bytes sent        {:10d}".format(bytes_in))
+    print("    bytes received    {:10d}".format(bytes_out))
+    print("    server errors     {:10d}".format(errors))
+    # only the sync client, the fake wikis run in another process
+    print("    peak memory       {:10.2f} MB".format(peak / 1024 / 1024))
+    for wiki, wiki_stats in stats:
+        print("    {:<8} actions  {}".format(wiki, wiki_stats["actions"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark sync_all_pages / sync_all_images against local fake wikis")
+    parser.add_argument("--pages", type=int, default=100, help="number of pages, e.g. 100 - 50000")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--page-size", type=int, default=2000, help="characters per page")
+    parser.add_argument("--file-size", type=int, default=100000, help="bytes per file")
+    parser.add_argument("--diff", type=float, default=0.3, help="ratio of pages that differ")
+    parser.add_argument("--missing", type=float, default=0.1, help="ratio of pages missing on one wiki")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per second before 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="ratio of requests answered with 503")
+    parser.add_argument("--captcha", action="store_true", help="ask a captcha for every edit")
+    parser.add_argument("--read-rate", type=float, default=0, help="client read limit, 0 = no limit")
+    parser.add_argument("--edit-rate", type=float, default=0, help="client edit limit, 0 = no limit")
+    parser.add_argument("--chunk-size", type=int, default=4 * 1024 * 1024, help="upload files larger than this in chunks, 0 = off")
+    parser.add_argument("--max-upload", type=int, default=0, help="bytes per upload request the server accepts, 0 = no limit")
+    parser.add_argument("--blob-cache", default="", help="folder of the blob cache for sync_all_images, empty = off")
+    parser.add_argument("--backfill", action="store_true", help="read the pages from Special:Export")
+    parser.add_argument("--section-size", type=int, default=0, help="edit pages of at least this many bytes by section, 0 = off")
+    parser.add_argument("--section-conflict", type=float, default=0.0, help="ratio of section edits (other than section 0) answered with an edit conflict")
+    parser.add_argument("--workers", type=int, default=sync_page.SyncEngine.WORKERS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('wiki')
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logger.setLevel(logging.CRITICAL)
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve_wikis, args=(args, child_conn), daemon=True)
+    server.start()
+    wikis, titles, files = conn.recv()
+    for key in wikis:
+        wikis[key].update({ "readRate": args.read_rate, "editRate": args.edit_rate, "chunkSize": args.chunk_size })
+    if len(titles) > 0:
+        synchronizer = sync_page.WikiSync(wikis, logger, args.workers)
+        synchronizer.section_edit_size = args.section_size
+        synchronizer.backfill = args.backfill
+        run("sync_all_pages", lambda: synchronizer.sync_all_pages(titles), len(titles), conn)
+        # a failed section edit must not leave a page half-synced
+        print("    diverged pages    {:10d}".format(call(conn, "diverged", titles)))
+        sync_page.editor_pool.close()
+    if len(files) > 0:
+        synchronizer = sync_file.WikiSync(wikis, logger, args.workers)
+        if args.blob_cache:
+            synchronizer.cache = sync_file.BlobCache(args.blob_cache)
+        run("sync_all_images", lambda: synchronizer.sync_all_images(files), len(files), conn)
+        sync_file.editor_pool.close()
+    call(conn, "stop")
+    server.join()
@@ -0,0 +1,91 @@
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import wikitext
+
+
+# the line based implementation before the transform engine, kept as reference
+def legacy_clean(srcCode, is_template):
+    srcCode = srcCode.replace("fandom-table", "wikitable")
+    lines = srcCode.split('\n')
+    for idx in range(0, len(lines)):
+        for tm in ["mirrorpage", r"synchro\|[^\}]*"]:
+            if is_template:
+                lines[idx] = re.sub(r"\<noinclude\>\{\{" + tm + r"\}\}\<\/noinclude\>", "", lines[idx])
+            else:
+                lines[idx] = re.sub(r"\{\{" + tm + r"\}\}", "", lines[idx])
+    return ('\n'.join(lines))
+
+
+def legacy_normalize(text):
+    return re.sub(r"\n|\s", "", text).lower()
+
+
+def make_page(rows, seed):
+    # a long list page similar to the series / episode lists
+    rnd = random.Random(seed)
+    lines = ["{{mirrorpage}}", "{{synchro|Reko Wiki|2024年01月01日 12:00}}", "{{h0|列表}}", "== 列表 ==",
+        '{| class="fandom-table"', "! 話數 !! 標題 !! 播出日期"]
+    for idx in range(0, rows):
+        lines.append("|-")
+        lines.append("| {} || [[第{}話]] {} || {}-{:02d}-{:02d}".format(
+            idx, idx, "".join(rnd.choice("ABCDEFGHIJ あいうえお") for _ in range(40)),
+            2000 + idx % 20, idx % 12 + 1, idx % 28 + 1))
+    lines.append("|}")
+    lines.append("[[分類:列表]]")
+    return "\n".join(lines)
+
+
+def load_corpus(path, pages, rows):
+    # use the pages in a folder (*.txt / *.wiki) if given, otherwise generate large list pages
+    if path is None:
+        return [ make_page(rows, idx) for idx in range(0, pages) ]
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".txt") or name.endswith(".wiki"):
+            with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def bench(name, func, corpus, repeat):
+    size = sum(len(text) for text in corpus)
+    best = None
+    for _ in range(0, repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            func(text)
+        spent = time.perf_counter() - start
+        best = spent if best is None else min(best, spent)
+    print("{:<20} {:>10.2f} ms {:>10.2f} MB/s".format(name, best * 1000, size / best / 1024 / 1024))
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="micro-benchmark of the wikitext transform")
+    parser.add_argument("--corpus", help="folder of wikitext pages (*.txt, *.wiki)")
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus, args.pages, args.rows)
+    print("{} pages, {:.2f} MB".format(len(corpus), sum(len(text) for text in corpus) / 1024 / 1024))
+
+    # both implementations must give the same result
+    for text in corpus:
+        for is_template in [False, True]:
+            assert wikitext.clean(text, is_template) == legacy_clean(text, is_template)
+        assert wikitext.normalize(text) == legacy_normalize(text)
+
+    old = bench("legacy clean", lambda text: legacy_clean(text, False), corpus, args.repeat)
+    new = bench("clean", lambda text: wikitext.clean(text, False), corpus, args.repeat)
+    print("speed up: {:.1f}x".format(old / new))
+    old = bench("legacy normalize", legacy_normalize, corpus, args.repeat)
+    new = bench("normalize", wikitext.normalize, corpus, args.repeat)
+    print("speed up: {:.1f}x".format(old / new))
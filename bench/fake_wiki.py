@@ -0,0 +1,620 @@
+import re
+import json
+import xml.sax.saxutils
+import time
+import random
+import hashlib
+import threading
+import urllib.parse
+import http.server
+import socketserver
+
+
+# a local stand-in for the MediaWiki api used by WikiEditor, for benchmarks and load tests
+
+
+def timestamp(t=None):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() if t is None else t))
+
+
+def normalize_title(title):
+    title = title.replace("_", " ").strip()
+    return title[:1].upper() + title[1:]
+
+
+# namespace ids and local names, like a zh wiki
+NAMESPACES = { 0: "", 6: "檔案", 10: "模板", 14: "分類", 828: "模組" }
+CANONICAL = { 6: "File", 10: "Template", 14: "Category", 828: "Module" }
+
+
+def namespace_of(title):
+    for ns, name in NAMESPACES.items():
+        if ns != 0 and title.startswith(name + ":"):
+            return ns
+    return 0
+
+
+def local_title(title):
+    # "Template:Z" -> "模板:Z"
+    name, sep, rest = title.partition(":")
+    for ns, canonical in CANONICAL.items():
+        if sep and name == canonical:
+            return NAMESPACES[ns] + ":" + rest
+    return normalize_title(title)
+
+
+def replace_section(text, section, new_text):
+    # replace section number "section" and its subsections like the edit api does, None if there is no such section
+    headings = list(re.finditer(r"^(={1,6})(.+?)(={1,6})[ \t]*$", text, re.MULTILINE))
+    if section == 0:
+        start = 0
+        end = headings[0].start() if len(headings) > 0 else len(text)
+    elif section <= len(headings):
+        match = headings[section - 1]
+        level = min(len(match.group(1)), len(match.group(3)))
+        start = match.start()
+        end = len(text)
+        for other in headings[section:]:
+            if min(len(other.group(1)), len(other.group(3))) <= level:
+                end = other.start()
+                break
+    else:
+        return None
+    new_text = new_text.rstrip()
+    if end < len(text):
+        new_text += "\n\n"
+    return text[:start] + new_text + text[end:]
+
+
+class FakeWiki(object):
+
+    # latency: seconds added to every request
+    # rate_limit: max. requests per second before answering 429, 0 = no limit
+    # error_rate: probability of answering 503
+    # captcha: ask a captcha for every first edit attempt
+    # lag: database lag reported to requests with "maxlag"
+    # section_conflict: probability of an edit conflict for an edit of a section other than 0
+    def __init__ (self, name, latency=0.0, rate_limit=0, error_rate=0.0, captcha=False, lag=0, seed=0):
+        self.name = name
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.captcha = captcha
+        self.lag = lag
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.pages = {} # title: [ revision ]
+        self.files = {} # title: [ version ]
+        self.recent = [] # recent changes
+        self.uploads = [] # upload log
+        self.logs = [] # move log
+        self.pageids = {} # title: page id
+        self.revisions = {} # revid: (title, revision)
+        self.sessions = {} # session id: csrf token
+        self.captchas = {} # captcha id: answer
+        self.stash = {} # file key: bytes of a chunked upload
+        self.max_upload = 0 # max. bytes per upload request, 0 = no limit
+        self.section_conflict = 0.0
+        self.revid = 0
+        self.rcid = 0
+        self.window = [0, 0] # rate limit window: second, count
+        self.base_url = ""
+        self.stats = { "requests": 0, "bytes_in": 0, "bytes_out": 0, "errors": 0, "actions": {} }
+
+    # ---- data ----
+
+    def add_page(self, title, text, user="User", comment="", ts=None):
+        with self.lock:
+            title = normalize_title(title)
+            self.revid += 1
+            self.rcid += 1
+            rev = { "revid": self.revid, "timestamp": ts or timestamp(), "user": user, "comment": comment, "*": text }
+            rc_type = "edit" if title in self.pages else "new"
+            self.pageids.setdefault(title, len(self.pageids) + 1)
+            self.pages.setdefault(title, []).append(rev)
+            self.revisions[rev["revid"]] = (title, rev)
+            self.recent.append({ "type": rc_type, "title": title, "rcid": self.rcid, "revid": self.revid,
+                "timestamp": rev["timestamp"], "user": user, "comment": comment })
+            return rev
+
+    def move_page(self, title, new_title, user="User", comment="", noredirect=False, ts=None):
+        with self.lock:
+            title = normalize_title(title)
+            new_title = normalize_title(new_title)
+            ts = ts or timestamp()
+            self.pages[new_title] = self.pages.pop(title)
+            self.pageids[new_title] = self.pageids.pop(title)
+            # a null revision is added to the history of the moved page
+            reason = "{} moved page [[{}]] to [[{}]]".format(user, title, new_title) + (": " + comment if comment else "")
+            self.revid += 1
+            self.pages[new_title].append(dict(self.pages[new_title][-1], revid=self.revid, timestamp=ts, user=user, comment=reason))
+            for rev in self.pages[new_title]:
+                self.revisions[rev["revid"]] = (new_title, rev)
+            if not noredirect:
+                self.add_page(title, "#REDIRECT [[{}]]".format(new_title), user, reason, ts)
+            params = { "target_ns": 0, "target_title": new_title }
+            if noredirect:
+                params["suppressredirect"] = ""
+            self.logs.append({ "logid": len(self.logs) + 1, "type": "move", "action": "move", "title": title,
+                "timestamp": ts, "user": user, "comment": comment, "params": params })
+
+    def add_file(self, title, data, user="User", comment="", ts=None):
+        with self.lock:
+            title = normalize_title(title)
+            version = { "timestamp": ts or timestamp(), "user": user, "comment": comment, "data": data,
+                "sha1": hashlib.sha1(data).hexdigest(), "size": len(data) }
+            self.files.setdefault(title, []).append(version)
+            self.pageids.setdefault(title, len(self.pageids) + 1)
+            self.uploads.append(dict(version, title=title))
+            return version
+
+    def latest(self, title):
+        revs = self.pages.get(normalize_title(title))
+        return revs[-1] if revs else None
+
+    # ---- request handling ----
+
+    def handle(self, params, cookie):
+        # return (http status, headers, body bytes, cookie to set)
+        self.stats["requests"] += 1
+        action = params.get("action", "")
+        self.stats["actions"][action] = self.stats["actions"].get(action, 0) + 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.rate_limit > 0:
+            with self.lock:
+                now = int(time.time())
+                if self.window[0] != now:
+                    self.window = [now, 0]
+                self.window[1] += 1
+                limited = self.window[1] > self.rate_limit
+            if limited:
+                self.stats["errors"] += 1
+                return 429, { "Retry-After": "1", "MediaWiki-API-Error": "ratelimited" }, self.json({ "error": { "code": "ratelimited", "info": "too many requests" } }), None
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return 503, { "Content-Type": "text/html" }, b"<html><body>Service Unavailable</body></html>", None
+        if "maxlag" in params and self.lag > int(params["maxlag"]):
+            return 200, { "Retry-After": "1", "X-Database-Lag": str(self.lag), "MediaWiki-API-Error": "maxlag" }, self.json({ "error": {
+                "code": "maxlag", "info": "Waiting for a database server: {} seconds lagged.".format(self.lag), "lag": self.lag } }), None
+        func = getattr(self, "do_" + action, None)
+        if func is None:
+            return 200, {}, self.json({ "error": { "code": "badvalue", "info": "unknown action " + action } }), None
+        with self.lock:
+            result = func(params, cookie)
+        cookie = None
+        if isinstance(result, str):
+            return 200, { "Content-Type": "application/xml; charset=utf-8" }, result.encode("utf-8"), None
+        if isinstance(result, tuple):
+            result, cookie = result
+        headers = {}
+        if "error" in result:
+            headers["MediaWiki-API-Error"] = result["error"]["code"]
+        return 200, headers, self.json(result), cookie
+
+    def json(self, data):
+        return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+    def error(self, code, info=""):
+        return { "error": { "code": code, "info": info } }
+
+    def do_login(self, params, cookie):
+        if params.get("lgtoken") != "logintoken+\\":
+            return { "login": { "result": "WrongToken" } }
+        session = "s{}".format(self.random.randrange(1 << 30))
+        self.sessions[session] = "csrf{}+\\".format(self.random.randrange(1 << 30))
+        return { "login": { "result": "Success", "lgusername": params.get("lgname") } }, session
+
+    def do_logout(self, params, cookie):
+        if cookie not in self.sessions or params.get("token") != self.sessions[cookie]:
+            return self.error("badtoken", "Invalid CSRF token.")
+        del self.sessions[cookie]
+        return {}
+
+    def do_query(self, params, cookie):
+        result = { "batchcomplete": "" }
+        query = {}
+        if params.get("meta") == "tokens":
+            if params.get("type") == "login":
+                query["tokens"] = { "logintoken": "logintoken+\\" }
+            else:
+                query["tokens"] = { "csrftoken": self.sessions.get(cookie, "+\\") }
+        if params.get("meta") == "siteinfo":
+            query["namespaces"] = { str(ns): dict({ "id": ns, "*": name }, **({ "canonical": CANONICAL[ns] } if ns in CANONICAL else {}))
+                for ns, name in NAMESPACES.items() }
+            query["namespacealiases"] = []
+        if params.get("list") == "recentchanges":
+            self.list_recentchanges(params, query, result)
+        if params.get("list") == "logevents":
+            self.list_logevents(params, query, result)
+        if params.get("list") == "allimages":
+            self.list_allimages(params, query, result)
+        if "export" in params:
+            return self.export(params["titles"].split("|"))
+        if params.get("generator") == "allpages":
+            self.generate_allpages(params, query, result)
+        elif params.get("generator") in ["categorymembers", "embeddedin"]:
+            self.generate_members(params, query, result)
+        elif "titles" in params:
+            self.query_titles(params, query, result)
+        if "revids" in params:
+            self.query_revids(params, query, result)
+        result["query"] = query
+        return result
+
+    def list_recentchanges(self, params, query, result):
+        limit = int(params.get("rclimit", 10))
+        start = params.get("rcstart", "")
+        if params.get("rcdir", "older") == "newer":
+            changes = [ rc for rc in self.recent if rc["timestamp"] >= start ]
+        else:
+            changes = [ rc for rc in reversed(self.recent) if start == "" or rc["timestamp"] <= start ]
+        offset = int(params.get("rccontinue", "0"))
+        query["recentchanges"] = changes[offset:offset+limit]
+        if offset + limit < len(changes):
+            result["continue"] = { "rccontinue": str(offset + limit), "continue": "-||" }
+
+    def list_logevents(self, params, query, result):
+        limit = int(params.get("lelimit", 10))
+        start = params.get("lestart", "")
+        logs = [ en for en in self.logs if en["type"] == params.get("letype", en["type"]) and en["timestamp"] >= start ]
+        offset = int(params.get("lecontinue", "0"))
+        query["logevents"] = logs[offset:offset+limit]
+        if offset + limit < len(logs):
+            result["continue"] = { "lecontinue": str(offset + limit), "continue": "-||" }
+
+    def list_allimages(self, params, query, result):
+        limit = int(params.get("ailimit", 10))
+        start = params.get("aistart", "")
+        latest = sorted([ (versions[-1]["timestamp"], title) for title, versions in self.files.items() ])
+        latest = [ en for en in latest if en[0] >= start ]
+        offset = int(params.get("aicontinue", "0"))
+        query["allimages"] = [ { "name": title.split(":", 1)[-1], "title": title, "timestamp": ts,
+            "user": self.files[title][-1]["user"], "comment": self.files[title][-1]["comment"] }
+            for ts, title in latest[offset:offset+limit] ]
+        if offset + limit < len(latest):
+            result["continue"] = { "aicontinue": str(offset + limit), "continue": "-||" }
+
+    def generate_allpages(self, params, query, result):
+        # titles sorted like the wiki database, with "_" for spaces
+        limit = int(params.get("gaplimit", 10))
+        namespace = int(params.get("gapnamespace", "0"))
+        prefix = (NAMESPACES[namespace] + ":" if namespace != 0 else "") + params.get("gapprefix", "")
+        names = [ name for name in self.pages if namespace_of(name) == namespace and name.startswith(prefix) ]
+        names = sorted(names, key=lambda name: name.replace(" ", "_"))
+        start = params.get("gapcontinue", "")
+        names = [ name for name in names if name.replace(" ", "_") >= start ]
+        if len(names) > limit:
+            result["continue"] = { "gapcontinue": names[limit].replace(" ", "_"), "continue": "gapcontinue||" }
+        if len(names[:limit]) > 0:
+            self.query_titles(dict(params, titles="|".join(names[:limit])), query, result)
+
+    def generate_members(self, params, query, result):
+        # pages in a category ("[[分類:X]]" in the text) or using a template ("{{Z"), in page id order
+        if params["generator"] == "categorymembers":
+            prefix = "gcm"
+            name = local_title(params["gcmtitle"]).split(":", 1)[1]
+            pattern = re.compile(r"\[\[(?:分類|Category):" + re.escape(name) + r"[\]|]")
+        else:
+            prefix = "gei"
+            name = local_title(params["geititle"])
+            if name.startswith("模板:"):
+                name = name.split(":", 1)[1]
+            pattern = re.compile(r"\{\{" + re.escape(name) + r"[}|]")
+        limit = int(params.get(prefix + "limit", 10))
+        namespaces = [ int(ns) for ns in params.get(prefix + "namespace", "").split("|") if ns != "" ]
+        names = sorted([ name for name in self.pages if pattern.search(self.pages[name][-1]["*"]) is not None
+            and (len(namespaces) == 0 or namespace_of(name) in namespaces) ], key=lambda name: self.pageids[name])
+        offset = int(params.get(prefix + "continue", "0"))
+        if offset + limit < len(names):
+            result["continue"] = { prefix + "continue": str(offset + limit), "continue": prefix + "continue||" }
+        if len(names[offset:offset+limit]) > 0:
+            self.query_titles(dict(params, titles="|".join(names[offset:offset+limit])), query, result)
+
+    def export(self, titles):
+        # Special:Export xml of the latest revisions, as returned with "exportnowrap"
+        esc = xml.sax.saxutils.escape
+        out = ['<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.11/" version="0.11" xml:lang="zh">']
+        for title in titles:
+            name = normalize_title(title)
+            if name not in self.pages:
+                continue
+            rev = self.pages[name][-1]
+            out.append("<page><title>{}</title><ns>0</ns><id>{}</id><revision><id>{}</id><timestamp>{}</timestamp>"
+                "<contributor><username>{}</username></contributor><comment>{}</comment><model>wikitext</model>"
+                "<format>text/x-wiki</format><text bytes=\"{}\" xml:space=\"preserve\">{}</text><sha1>{}</sha1></revision></page>".format(
+                esc(name), self.pageids[name], rev["revid"], rev["timestamp"], esc(rev["user"]), esc(rev["comment"]),
+                len(rev["*"].encode("utf-8")), esc(rev["*"]), hashlib.sha1(rev["*"].encode("utf-8")).hexdigest()))
+        out.append("</mediawiki>")
+        return "\n".join(out)
+
+    def query_titles(self, params, query, result):
+        titles = params["titles"].split("|")
+        pages = {}
+        normalized = []
+        missing = 0
+        for title in titles:
+            name = normalize_title(title)
+            if name != title:
+                normalized.append({ "from": title, "to": name })
+            if name in self.pageids:
+                pageid = self.pageids[name]
+                page = { "pageid": pageid, "ns": namespace_of(name), "title": name }
+            else:
+                missing -= 1
+                pageid = missing
+                page = { "ns": namespace_of(name), "title": name, "missing": "" }
+            prop = params.get("prop", "").split("|")
+            if "info" in prop and name in self.pages:
+                page["lastrevid"] = self.pages[name][-1]["revid"]
+                page["length"] = len(self.pages[name][-1]["*"].encode("utf-8"))
+                if self.pages[name][-1]["*"].upper().startswith("#REDIRECT"):
+                    page["redirect"] = ""
+            if "revisions" in prop and name in self.pages:
+                page["revisions"] = [self.revision(name, self.pages[name][-1], params)]
+            if "templates" in prop and name in self.pages:
+                # only the templates used directly, the real api also lists those used through other templates
+                used = re.findall(r"\{\{([^{}|\n]+)", self.pages[name][-1]["*"])
+                used = [ local_title(en[1:]) if en.startswith(":") else local_title(en) if ":" in en else "模板:" + normalize_title(en) for en in used ]
+                # {{#invoke:X}} uses the module page
+                used = [ "模組:" + normalize_title(en.split(":", 2)[1]) if en.startswith("#invoke:") else en for en in used ]
+                namespaces = [ int(ns) for ns in params.get("tlnamespace", "").split("|") if ns != "" ]
+                page["templates"] = [ { "ns": namespace_of(en), "title": en } for en in sorted(set(used))
+                    if len(namespaces) == 0 or namespace_of(en) in namespaces ]
+            if "images" in prop and name in self.pages:
+                used = re.findall(r"\[\[(?:檔案|File):([^\]|]+)", self.pages[name][-1]["*"])
+                page["images"] = [ { "ns": 6, "title": "檔案:" + normalize_title(en) } for en in sorted(set(used)) ]
+            if "imageinfo" in prop and name in self.files:
+                version = self.files[name][-1]
+                props = params.get("iiprop", "timestamp|user").split("|")
+                info = { key: version[key] for key in ["timestamp", "user", "comment", "sha1", "size"] if key in props }
+                if "url" in props:
+                    info["url"] = self.base_url + "/files/" + urllib.parse.quote(name)
+                page["imageinfo"] = [info]
+                page["imagerepository"] = "local"
+            pages[str(pageid)] = page
+        if "redirects" in params:
+            # one step of each redirect, like the api does for a double redirect
+            redirects = []
+            for title in titles:
+                name = normalize_title(title)
+                match = re.match(r"#REDIRECT \[\[([^\]#|]+)", self.pages[name][-1]["*"], re.IGNORECASE) if name in self.pages else None
+                if match is not None:
+                    redirects.append({ "from": name, "to": normalize_title(match.group(1)) })
+            if len(redirects) > 0:
+                query["redirects"] = redirects
+        if len(normalized) > 0:
+            query["normalized"] = normalized
+        query["pages"] = pages
+
+    def query_revids(self, params, query, result):
+        pages = {}
+        badrevids = {}
+        for revid in params["revids"].split("|"):
+            if int(revid) not in self.revisions:
+                badrevids[revid] = { "revid": int(revid), "missing": "" }
+                continue
+            name, rev = self.revisions[int(revid)]
+            pageid = self.pageids[name]
+            page = pages.setdefault(str(pageid), { "pageid": pageid, "ns": namespace_of(name), "title": name, "revisions": [] })
+            page["revisions"].append(self.revision(name, rev, params))
+        if len(badrevids) > 0:
+            query["badrevids"] = badrevids
+        query["pages"] = pages
+
+    def revision(self, name, rev, params):
+        props = params.get("rvprop", "ids|timestamp").split("|")
+        out = {}
+        if "ids" in props:
+            history = self.pages[name]
+            idx = history.index(rev)
+            out["revid"] = rev["revid"]
+            out["parentid"] = history[idx-1]["revid"] if idx > 0 else 0
+        for key in ["timestamp", "user", "comment"]:
+            if key in props:
+                out[key] = rev[key]
+        if "sha1" in props:
+            out["sha1"] = hashlib.sha1(rev["*"].encode("utf-8")).hexdigest()
+        if "size" in props:
+            out["size"] = len(rev["*"].encode("utf-8"))
+        if "content" in props:
+            out["contentformat"] = "text/x-wiki"
+            out["contentmodel"] = "wikitext"
+            out["*"] = rev["*"]
+        return out
+
+    def check_token(self, params, cookie):
+        return cookie in self.sessions and params.get("token") == self.sessions[cookie]
+
+    def check_write(self, params, cookie):
+        # error for a write with an expired session or a wrong token, otherwise None
+        if params.get("assert") in ["user", "bot"] and cookie not in self.sessions:
+            return self.error("assert{}failed".format(params["assert"]), "You are no longer logged in.")
+        if not self.check_token(params, cookie):
+            return self.error("badtoken", "Invalid CSRF token.")
+        return None
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions = {}
+
+    def check_captcha(self, params):
+        if not self.captcha:
+            return None
+        if params.get("captchaid") in self.captchas and params.get("captchaword") == self.captchas[params["captchaid"]]:
+            del self.captchas[params["captchaid"]]
+            return None
+        a, b = self.random.randrange(1, 10), self.random.randrange(1, 10)
+        captcha_id = str(self.random.randrange(1 << 30))
+        self.captchas[captcha_id] = str(a + b)
+        return { "type": "simple", "mime": "text/plain", "id": captcha_id, "question": "{}+{}".format(a, b) }
+
+    def do_edit(self, params, cookie):
+        error = self.check_write(params, cookie)
+        if error is not None:
+            return error
+        captcha = self.check_captcha(params)
+        if captcha is not None:
+            return { "edit": { "result": "Failure", "captcha": captcha } }
+        title = normalize_title(params["title"])
+        old = self.latest(title)
+        text = params.get("text", "")
+        if "section" in params:
+            if old is None:
+                return self.error("nosuchsection", "There is no section {}.".format(params["section"]))
+            if int(params["section"]) > 0 and self.random.random() < self.section_conflict:
+                return self.error("editconflict", "Edit conflict.")
+            text = replace_section(old["*"], int(params["section"]), text)
+            if text is None:
+                return self.error("nosuchsection", "There is no section {}.".format(params["section"]))
+        if old is not None and old["*"] == text:
+            return { "edit": { "result": "Success", "title": title, "nochange": "" } }
+        rev = self.add_page(title, text, "Bot", params.get("summary", ""))
+        return { "edit": { "result": "Success", "title": title, "contentmodel": "wikitext",
+            "oldrevid": old["revid"] if old is not None else 0, "newrevid": rev["revid"], "newtimestamp": rev["timestamp"] } }
+
+    def do_move(self, params, cookie):
+        error = self.check_write(params, cookie)
+        if error is not None:
+            return error
+        title = normalize_title(params["from"])
+        new_title = normalize_title(params["to"])
+        if title not in self.pages:
+            return self.error("missingtitle", "The page you specified doesn't exist.")
+        if new_title in self.pages:
+            return self.error("articleexists", "A page of that name already exists.")
+        self.move_page(title, new_title, "Bot", params.get("reason", ""), "noredirect" in params)
+        return { "move": { "from": title, "to": new_title, "reason": params.get("reason", "") } }
+
+    def do_upload(self, params, cookie):
+        error = self.check_write(params, cookie)
+        if error is not None:
+            return error
+        title = normalize_title("檔案:" + params["filename"].split(":", 1)[-1])
+        data = params.get("file", params.get("chunk", b""))
+        if self.max_upload > 0 and len(data) > self.max_upload:
+            return self.error("file-too-large", "The file is larger than {} bytes.".format(self.max_upload))
+        if "chunk" in params:
+            return self.stash_chunk(params, data)
+        if "filekey" in params:
+            if params["filekey"] not in self.stash:
+                return self.error("stashfailed", "No such file key: {}.".format(params["filekey"]))
+            data = bytes(self.stash.pop(params["filekey"]))
+        version = self.add_file(title, data, "Bot", params.get("comment", ""))
+        return { "upload": { "result": "Success", "filename": params["filename"],
+            "imageinfo": { key: version[key] for key in ["timestamp", "user", "comment", "sha1", "size"] } } }
+
+    def stash_chunk(self, params, chunk):
+        # chunked upload: the chunk must start where the stashed data ends
+        filekey = params.get("filekey")
+        if filekey is None:
+            filekey = "stash{}".format(self.random.randrange(1 << 30))
+            self.stash[filekey] = bytearray()
+        elif filekey not in self.stash:
+            return self.error("stashfailed", "No such file key: {}.".format(filekey))
+        data = self.stash[filekey]
+        if int(params.get("offset", 0)) != len(data):
+            return { "error": { "code": "stashfailed", "info": "Invalid chunk offset", "offset": len(data) } }
+        data.extend(chunk)
+        if len(data) >= int(params.get("filesize", 0)):
+            return { "upload": { "result": "Success", "filekey": filekey } }
+        return { "upload": { "result": "Continue", "offset": len(data), "filekey": filekey } }
+
+    def download(self, title):
+        with self.lock:
+            versions = self.files.get(normalize_title(title))
+            return versions[-1]["data"] if versions else None
+
+
+class FakeWikiHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def session_cookie(self):
+        for part in self.headers.get("Cookie", "").split(";"):
+            if part.strip().startswith("session="):
+                return part.strip()[len("session="):]
+        return None
+
+    def reply(self, status, headers, body, cookie):
+        wiki = self.server.wiki
+        wiki.stats["bytes_out"] += len(body)
+        self.send_response(status)
+        self.send_header("Content-Type", headers.pop("Content-Type", "application/json; charset=utf-8"))
+        self.send_header("Content-Length", str(len(body)))
+        for key in headers:
+            self.send_header(key, headers[key])
+        if cookie is not None:
+            self.send_header("Set-Cookie", "session={}; Path=/".format(cookie))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        self.server.wiki.stats["bytes_in"] += len(self.path)
+        if url.path.startswith("/files/"):
+            data = self.server.wiki.download(urllib.parse.unquote(url.path[len("/files/"):]))
+            if data is None:
+                return self.reply(404, { "Content-Type": "text/plain" }, b"not found", None)
+            self.server.wiki.stats["requests"] += 1
+            return self.reply(200, { "Content-Type": "application/octet-stream" }, data, None)
+        params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        self.reply(*self.server.wiki.handle(params, self.session_cookie()))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.wiki.stats["bytes_in"] += len(body)
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            params = self.parse_multipart(content_type, body)
+        else:
+            params = dict(urllib.parse.parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+        query = urllib.parse.urlsplit(self.path).query
+        params.update(dict(urllib.parse.parse_qsl(query, keep_blank_values=True)))
+        self.reply(*self.server.wiki.handle(params, self.session_cookie()))
+
+    def parse_multipart(self, content_type, body):
+        # split by the boundary, the file parts are kept as bytes
+        boundary = content_type.split("boundary=", 1)[1].strip('"').encode("utf-8")
+        params = {}
+        for part in body.split(b"--" + boundary)[1:-1]:
+            head, _, data = part[2:].partition(b"\r\n\r\n")
+            head = head.decode("utf-8")
+            name = re.search(r'name="([^"]*)"', head).group(1)
+            data = data[:-2]
+            if re.search(r'filename="', head) is None:
+                data = data.decode("utf-8")
+            params[name] = data
+        return params
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer needs python 3.7
+    daemon_threads = True
+
+
+class FakeWikiServer(object):
+
+    # run a FakeWiki on a local port in a background thread
+    def __init__ (self, wiki, port=0):
+        self.wiki = wiki
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), FakeWikiHandler)
+        self.httpd.wiki = wiki
+        wiki.base_url = "http://127.0.0.1:{}".format(self.httpd.server_port)
+        self.url = wiki.base_url + "/api.php"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def info(self, name=None):
+        # wiki entry for config.json
+        return { "name": name or self.wiki.name, "url": self.url, "botName": "Bot@sync", "botPassword": "secret" }
@@ -0,0 +1,103 @@
+import os
+import io
+import mmap
+import tempfile
+import threading
+import collections
+
+
+class BlobCache(object):
+
+    # default folder of the cache, next to config.json
+    PATH = "blob_cache"
+    # default max. size of the cache in MB
+    MAX_SIZE = 1024
+
+    # downloaded files kept on disk by their sha1, e.g. blob_cache/ab/ab12...
+    # a file is only added by renaming a complete temp file, so a crash never leaves a broken entry,
+    # the least recently used files are removed when the cache is larger than max_size (bytes)
+    def __init__ (self, path=PATH, max_size=MAX_SIZE * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # sha1: size, least recently used first
+        self.total = 0
+        os.makedirs(path, exist_ok=True)
+        found = []
+        for folder in os.listdir(path):
+            if not os.path.isdir(os.path.join(path, folder)):
+                # temp file left by a crash
+                if folder.endswith(".tmp"):
+                    os.remove(os.path.join(path, folder))
+                continue
+            for name in os.listdir(os.path.join(path, folder)):
+                stat = os.stat(os.path.join(path, folder, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.total += size
+
+    def file_path(self, sha1):
+        return os.path.join(self.path, sha1[:2], sha1)
+
+    def open(self, sha1, size=None):
+        # return a read-only memory-mapped buffer of the file, or None if it is not cached
+        with self.lock:
+            if sha1 not in self.entries:
+                return None
+            if size is not None and self.entries[sha1] != size:
+                self.remove(sha1)
+                return None
+            self.entries.move_to_end(sha1)
+        path = self.file_path(sha1)
+        try:
+            os.utime(path)
+            with open(path, "rb") as f:
+                if self.entries.get(sha1) == 0:
+                    return io.BytesIO(b"")
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            with self.lock:
+                self.remove(sha1)
+            return None
+
+    def create(self):
+        # temp file in the cache folder to download into, then commit() or discard() it
+        return tempfile.NamedTemporaryFile(dir=self.path, suffix=".tmp", delete=False)
+
+    def commit(self, file, sha1):
+        # add the downloaded temp file as the file with this sha1, return it like open()
+        file.flush()
+        os.fsync(file.fileno())
+        size = os.fstat(file.fileno()).st_size
+        file.close()
+        os.makedirs(os.path.join(self.path, sha1[:2]), exist_ok=True)
+        os.replace(file.name, self.file_path(sha1))
+        with self.lock:
+            if sha1 in self.entries:
+                self.total -= self.entries[sha1]
+            self.entries[sha1] = size
+            self.total += size
+            self.evict(keep=sha1)
+        return self.open(sha1)
+
+    def discard(self, file):
+        file.close()
+        if os.path.exists(file.name):
+            os.remove(file.name)
+
+    def evict(self, keep=None):
+        # remove the least recently used files until the cache fits in max_size
+        for sha1 in list(self.entries):
+            if self.total <= self.max_size:
+                break
+            if sha1 != keep:
+                self.remove(sha1)
+
+    def remove(self, sha1):
+        try:
+            os.remove(self.file_path(sha1))
+        except OSError:
+            # still open (e.g. memory-mapped on windows), try again next time
+            return
+        self.total -= self.entries.pop(sha1, 0)
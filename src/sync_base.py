@@ -0,0 +1,134 @@
+import json
+import datetime
+import contextlib
+import logging
+from sync_engine import SyncEngine
+from sync_metrics import metrics
+import sync_metrics
+from sync_state import SyncState
+from blob_cache import BlobCache
+from wiki_transport import SESSION_MAX_AGE
+import sync_log
+
+
+class SyncBase(object):
+
+    # what the page and file sync have in common: the workers, the sync state, the journal of the run,
+    # the cursors of the listings and the metrics of each title
+
+    # kinds of listing with a cursor, e.g. "recentchanges"
+    CURSOR_KINDS = ()
+
+    def __init__ (self, wiki, logger, workers=SyncEngine.WORKERS, state=None):
+        self.wikis = wiki
+        self.logger = logger
+        self.engine = SyncEngine(workers)
+        self.state = state # SyncState, skip titles not changed since last sync
+        self.cursors = { kind: {} for kind in self.CURSOR_KINDS } # kind: { wiki: (timestamp, id) of the latest entry listed }
+        self.profile_titles = set() # titles to run under cProfile
+        self.journal = None # RunJournal, titles done so far for --resume
+
+    def configure(self, data):
+        # settings of config.json
+        self.profile_titles = set(data.get("profileTitles", []))
+
+    def recent_cursor(self, key, kind):
+        # continue from the last listing of this process (watch mode),
+        # else start from where the last run stopped, or from yesterday if no cursor is saved
+        if key in self.cursors[kind]:
+            return self.cursors[kind][key]
+        cursor = self.state.get_cursor(key, kind) if self.state is not None else None
+        if cursor is None:
+            return (datetime.date.today() + datetime.timedelta(days = -1)).strftime("%Y-%m-%d") + 'T00:00:00Z', 0
+        return tuple(cursor)
+
+    def save_cursors(self, before=None):
+        # call after the titles are synced, so a failed run will list them again
+        # "before": timestamp of the oldest change not synced yet (watch mode), the next run lists again from there
+        if self.state is None:
+            return
+        for kind in self.cursors:
+            for key in self.cursors[kind]:
+                cursor = tuple(self.cursors[kind][key])
+                if before is not None:
+                    cursor = min(cursor, (before, 0))
+                self.state.set_cursor(key, kind, *cursor)
+
+    @contextlib.contextmanager
+    def measure(self, title):
+        # time each title, run it under cProfile if it is listed in "profileTitles"
+        with metrics.timer("phase", None, "title"):
+            if title in self.profile_titles:
+                with sync_metrics.profile(self.logger, title, sync_metrics.profile_path(title)):
+                    yield
+            else:
+                yield
+
+    def event(self, title, wiki, action, outcome, bytes_sent=0, latency=0.0):
+        metrics.count("outcomes", self.wikis[wiki]["name"] if wiki is not None else None, action + ":" + outcome)
+        sync_log.log_event(self.logger, title, wiki, action, outcome, bytes_sent, latency)
+        if self.journal is not None:
+            self.journal.event(title, wiki, action, outcome)
+
+    def done(self, title):
+        # the title is handled on all wikis, a resumed run will not sync it again
+        if self.journal is not None:
+            self.journal.done(title)
+
+    def plan(self, titles):
+        # what a resumed run needs: the titles and the cursors to save at the end
+        return { "titles": titles, "cursors": self.cursors }
+
+    def resume(self, plan):
+        saved = plan.get("cursors", {})
+        self.cursors = { kind: { key: tuple(value) for key, value in saved.get(kind, {}).items() } for kind in self.CURSOR_KINDS }
+        return plan["titles"]
+
+
+def read_config(path="config.json"):
+    # read config and start the logging, None if no wiki is set
+    logger = logging.getLogger('wiki')
+    with open(path, "r", encoding="utf-8") as jsonfile:
+        data = json.load(jsonfile)
+    # "eventLog": jsonl file of one event per title and target wiki, "" to disable
+    sync_log.setup_logging(sync_log.LOG_FILE, data.get("eventLog", sync_log.EVENT_FILE))
+    if ("wiki" not in data) or (len(data["wiki"]) == 0):
+        logger.error("設定錯誤: 沒有源頭")
+        return None
+    logger.info("同步: {}".format(str([ data["wiki"][key]["name"] for key in data["wiki"] ])))
+    return data
+
+
+def open_state(data):
+    # "stateFile": sqlite file of the synced revisions and cursors, "" to disable
+    if data.get("stateFile", SyncState.FILE_NAME):
+        return SyncState(data.get("stateFile", SyncState.FILE_NAME))
+    return None
+
+
+def open_cache(data):
+    # "blobCache": folder of the downloaded files, "" to disable, "blobCacheSize": in MB
+    if data.get("blobCache", BlobCache.PATH):
+        return BlobCache(data.get("blobCache", BlobCache.PATH), data.get("blobCacheSize", BlobCache.MAX_SIZE) * 1024 * 1024)
+    return None
+
+
+def setup_pool(pool, data):
+    # "sessionFile": save the sessions for the next run, "sessionMaxAge": seconds a saved session is reused
+    pool.session_file = data.get("sessionFile")
+    pool.max_age = data.get("sessionMaxAge", SESSION_MAX_AGE)
+
+
+def finish(data, state):
+    # report the metrics and clean up the sync state at the end of a run
+    logger = logging.getLogger('wiki')
+    for line in metrics.summary():
+        logger.info(line)
+    # "metricsFile": *.prom for a prometheus textfile, otherwise json
+    if data.get("metricsFile"):
+        metrics.write(data["metricsFile"])
+    if state is not None:
+        # "stateMaxAge": days an entry of the sync state is kept
+        if state.evict(data.get("stateMaxAge", SyncState.MAX_AGE)) > 0:
+            state.vacuum()
+        state.close()
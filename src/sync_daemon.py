@@ -0,0 +1,218 @@
+import heapq
+import signal
+import calendar
+import time
+import logging
+import threading
+from sync_engine import SyncEngine
+from sync_metrics import metrics
+from sync_state import SyncState
+import sync_page
+import sync_file
+import sync_base
+
+
+# seconds between two listings of the recent changes and uploads
+WATCH_INTERVAL = 60
+# a title is synced once it was not edited for this many seconds
+SETTLE_TIME = 120
+# ... but at most this many seconds after the first edit not synced yet
+MAX_DELAY = 900
+# max. titles of each kind synced in one cycle, the rest wait for the next cycle
+WATCH_BATCH = 500
+# the sync state is cleaned up once a day
+EVICT_INTERVAL = 24 * 3600
+# a title that failed to sync is tried again after this many seconds, twice as long after each failure,
+# and given up after RETRIES failures in a row
+RETRY_DELAY = 60
+RETRIES = 5
+
+
+def parse_timestamp(timestamp):
+    # "2024-01-31T12:34:56Z" of the wiki to unix time
+    return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+class WatchQueue(object):
+
+    # titles waiting to be synced, ordered by when they are due:
+    # a title is due "settle" seconds after its last edit, so a burst of edits is synced once,
+    # but at most "max_delay" seconds after its first edit, so a page edited all the time is still synced
+    def __init__ (self, settle=SETTLE_TIME, max_delay=MAX_DELAY):
+        self.settle = settle
+        self.max_delay = max_delay
+        self.heap = [] # (due, title), entries made out of date by a later edit are skipped
+        self.entries = {} # title: [first edit, last edit, timestamp of the first edit, failures, not before]
+        self.synced = {} # title: last edit synced, the upload cursor lists the same second again
+        self.syncing = {} # title: entry, the titles of the last pop_ready() until they are synced
+
+    def __len__(self):
+        return len(self.entries)
+
+    def due(self, entry):
+        return max(entry[4], min(entry[1] + self.settle, entry[0] + self.max_delay))
+
+    def add(self, title, timestamp):
+        # return False if the edit is already queued or synced
+        edit = parse_timestamp(timestamp)
+        if edit <= self.synced.get(title, -1):
+            return False
+        entry = self.entries.get(title)
+        if entry is None:
+            entry = self.entries[title] = [edit, edit, timestamp, 0, 0]
+        elif edit > entry[1]:
+            entry[1] = edit
+        else:
+            return False
+        heapq.heappush(self.heap, (self.due(entry), title))
+        return True
+
+    def pop_ready(self, now, limit=WATCH_BATCH):
+        # the due titles, the longest waiting first
+        ready = []
+        self.syncing = {}
+        while len(self.heap) > 0 and self.heap[0][0] <= now and len(ready) < limit:
+            due, title = heapq.heappop(self.heap)
+            entry = self.entries.get(title)
+            if entry is None or self.due(entry) != due:
+                continue
+            del self.entries[title]
+            self.synced[title] = entry[1]
+            self.syncing[title] = entry
+            ready.append(title)
+        # edits older than the max. delay are not listed again
+        self.synced = { title: edit for title, edit in self.synced.items() if edit > now - self.max_delay - self.settle }
+        return ready
+
+    def retry(self, title, now):
+        # queue a title of the last pop_ready() again after its sync failed, return False if it failed too often
+        # titles not from this queue (e.g. redirect targets) are synced again when they are edited
+        entry = self.syncing.pop(title, None)
+        if entry is None:
+            return True
+        if entry[3] + 1 >= RETRIES:
+            return False
+        entry[3] += 1
+        entry[4] = now + RETRY_DELAY * 2 ** (entry[3] - 1)
+        self.entries[title] = entry
+        heapq.heappush(self.heap, (self.due(entry), title))
+        return True
+
+    def oldest(self):
+        # timestamp of the oldest edit not synced yet, or None
+        if len(self.entries) == 0:
+            return None
+        return min(entry[2] for entry in self.entries.values())
+
+
+class SyncDaemon(object):
+
+    # list the recent changes and uploads every "interval" seconds and sync the titles once they settled,
+    # the editors stay logged in between the cycles
+    def __init__ (self, page_sync, file_sync, logger, interval=WATCH_INTERVAL, settle=SETTLE_TIME, max_delay=MAX_DELAY, batch=WATCH_BATCH):
+        self.page_sync = page_sync
+        self.file_sync = file_sync
+        self.logger = logger
+        self.interval = interval
+        self.batch = batch
+        self.pages = WatchQueue(settle, max_delay)
+        self.files = WatchQueue(settle, max_delay)
+        self.metrics_file = None
+        self.stopped = threading.Event()
+
+    def stop(self, *args):
+        # finish the current cycle, then exit
+        self.logger.info("停止監察模式")
+        self.stopped.set()
+
+    def poll_pages(self):
+        queued = 0
+        for title, timestamp in self.page_sync.list_recent_changes().items():
+            reason = sync_page.WikiSync.non_sync_reason(title)
+            if reason is not None:
+                self.logger.error("錯誤:不能同步{} - {}".format(reason, title))
+            elif self.pages.add(title, timestamp):
+                queued += 1
+        return queued
+
+    def poll_files(self):
+        queued = 0
+        for title, timestamp in self.file_sync.list_recent_uploads().items():
+            if self.files.add(title, timestamp):
+                queued += 1
+        return queued
+
+    def run_once(self):
+        # one cycle: list, then sync the titles that are due
+        for name, sync, queue, poll, sync_all in [
+            ("頁面", self.page_sync, self.pages, self.poll_pages, self.page_sync.sync_all_pages),
+            ("檔案", self.file_sync, self.files, self.poll_files, self.file_sync.sync_all_images)]:
+            try:
+                queued = poll()
+            except Exception as e:
+                self.logger.error("讀取最近更新{}失敗:{}".format(name, str(e)))
+                continue
+            ready = queue.pop_ready(time.time(), self.batch)
+            if queued > 0 or len(ready) > 0:
+                self.logger.info("監察模式: 新增{}個{}，同步{}個，等待中{}個".format(queued, name, len(ready), len(queue)))
+            # page moves are replayed right away, by sync_all_pages
+            if len(ready) > 0 or len(getattr(sync, "moves", [])) > 0:
+                try:
+                    failed = sync_all(ready)
+                except Exception as e:
+                    self.logger.error("監察模式同步{}失敗:{}".format(name, str(e)))
+                    failed = ready
+                # the daemon has no journal, the titles that failed are tried again later
+                for title in failed:
+                    if not queue.retry(title, time.time()):
+                        self.logger.error("{}多次同步失敗，放棄重試".format(title))
+            # titles still waiting are listed again if the daemon is restarted
+            sync.save_cursors(queue.oldest())
+        if self.metrics_file:
+            metrics.write(self.metrics_file)
+
+    def run(self, state=None, state_max_age=SyncState.MAX_AGE):
+        last_evict = time.monotonic()
+        while not self.stopped.is_set():
+            start = time.monotonic()
+            self.run_once()
+            if state is not None and start - last_evict > EVICT_INTERVAL:
+                last_evict = start
+                if state.evict(state_max_age) > 0:
+                    state.vacuum()
+            self.stopped.wait(max(0, self.interval - (time.monotonic() - start)))
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger('wiki')
+
+    # read config
+    data = sync_base.read_config()
+    if data is None:
+        quit()
+
+    state = sync_base.open_state(data)
+
+    page_sync = sync_page.WikiSync(data["wiki"], logger, data.get("workers", SyncEngine.WORKERS), state)
+    page_sync.configure(data)
+    file_sync = sync_file.WikiSync(data["wiki"], logger, data.get("workers", SyncEngine.WORKERS), state)
+    file_sync.configure(data)
+    sync_base.setup_pool(sync_page.editor_pool, data)
+    # the file editors use the sessions of the page editors, one login per wiki
+    sync_file.editor_pool.parent = sync_page.editor_pool
+
+    daemon = SyncDaemon(page_sync, file_sync, logger,
+        data.get("watchInterval", WATCH_INTERVAL), data.get("settleTime", SETTLE_TIME),
+        data.get("maxDelay", MAX_DELAY), data.get("watchBatch", WATCH_BATCH))
+    # "metricsFile" is rewritten after every cycle
+    daemon.metrics_file = data.get("metricsFile")
+    signal.signal(signal.SIGTERM, daemon.stop)
+    logger.info("起動監察模式: 每{}秒檢查一次".format(daemon.interval))
+    try:
+        daemon.run(state, data.get("stateMaxAge", SyncState.MAX_AGE))
+    except KeyboardInterrupt:
+        daemon.stop()
+    sync_file.editor_pool.close()
+    sync_page.editor_pool.close()
+
+    sync_base.finish(data, state)
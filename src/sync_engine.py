@@ -0,0 +1,139 @@
+import queue
+import threading
+import contextlib
+import time
+import concurrent.futures
+
+
+def prefetch(items, size=1000):
+    # iterate "items" in a background thread, at most "size" items ahead of the caller
+    buffer = queue.Queue(size)
+    end = object()
+    def produce():
+        try:
+            for item in items:
+                buffer.put((item, None))
+        except Exception as e:
+            buffer.put((None, e))
+        buffer.put((end, None))
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = buffer.get()
+        if error is not None:
+            raise error
+        if item is end:
+            return
+        yield item
+
+
+class RateLimiter(object):
+
+    # lowest rate slow_down() goes to, in requests per second
+    MIN_RATE = 0.1
+
+    # token bucket: refill "rate" tokens per second, hold at most "burst" tokens
+    # the rate adapts to the server: halved by slow_down(), raised step by step by speed_up()
+    # up to the configured rate, pause() holds all requests e.g. for a "Retry-After"
+    def __init__ (self, rate, burst=1):
+        self.rate = float(rate)
+        self.max_rate = self.rate
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def slow_down(self):
+        with self.lock:
+            if self.max_rate > 0:
+                self.rate = max(min(RateLimiter.MIN_RATE, self.max_rate), self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        if self.rate <= 0: # no limit
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SyncEngine(object):
+
+    # default number of titles to sync at the same time
+    WORKERS = 4
+
+    def __init__ (self, workers=WORKERS):
+        self.workers = max(1, int(workers))
+        self.title_locks = {} # title: [lock, tasks using it]
+        self.guard = threading.Lock()
+        self.wiki_pool = None
+
+    @contextlib.contextmanager
+    def title_lock(self, title):
+        # writes to the same title must stay in order,
+        # the lock is removed once no task holds or waits for it, so the table does not grow in a long run
+        with self.guard:
+            entry = self.title_locks.setdefault(title, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.title_locks[title]
+
+    def per_wiki(self, editors, func):
+        # run func(key, editor) for all wikis in parallel, return { key: result }
+        if len(editors) <= 1:
+            return { key: func(key, editors[key]) for key in editors }
+        with self.guard:
+            if self.wiki_pool is None:
+                self.wiki_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers * len(editors))
+        futures = { key: self.wiki_pool.submit(func, key, editors[key]) for key in editors }
+        return { key: futures[key].result() for key in futures }
+
+    def run(self, titles, func, on_error):
+        # run func(title) for all titles, several titles at once
+        # on_error(title, exception) is called when func fails
+        def task(title):
+            with self.title_lock(title):
+                try:
+                    func(title)
+                except Exception as e:
+                    on_error(title, e)
+        if self.workers == 1:
+            for title in titles:
+                task(title)
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [ pool.submit(task, title) for title in titles ]:
+                future.result()
+
+    def shutdown(self):
+        with self.guard:
+            if self.wiki_pool is not None:
+                self.wiki_pool.shutdown()
+                self.wiki_pool = None
@@ -1,22 +1,19 @@
-import re
 import os
+import argparse
 import io
-import json
-import requests
-import base64
+import hashlib
+import tempfile
 import contextlib
-import datetime
-import calendar
 import time
 import logging
+from sync_engine import SyncEngine
+from wiki_transport import WikiClient, EditorPool
+from sync_metrics import metrics
+from sync_journal import RunJournal
+from sync_base import SyncBase
+import sync_base
 
 
-FORMAT = '%(asctime)s: %(message)s'
-logging.basicConfig(format=FORMAT, datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO,  handlers=[
-    logging.FileHandler("auto_sync.log", encoding = "UTF-8"),
-    logging.StreamHandler()
-])
-
 def answer(equation):
     x = 0
     if '+' in equation:
@@ -29,93 +26,73 @@ def answer(equation):
 
 @contextlib.contextmanager
 def open_editor(wikis):
-    editors = { key:WikiEditor(wikis[key]) for key in wikis }
-    for key in editors:
-        editors[key].login()
-    yield editors
-    for key in editors:
-        editors[key].logout()
+    # editors are shared by all phases of the run and login lazily, see editor_pool.close()
+    yield editor_pool.get(wikis)
 
 
-class WikiEditor(object):
+class WikiEditor(WikiClient):
 
-    def __init__ (self, info):
-        self.info = info
-        self.sess = None
-    
-    def login(self):
-        self.sess = requests.Session()
-        # Get Request to fetch login token
-        para = {
-            "action": "query",
-            "meta": "tokens",
-            "type": "login",
-            "format": "json"
-        }
-        res = self.sess.get(url=self.info["url"], params=para)
-        data = res.json()
-        tokens = data['query']['tokens']['logintoken']
-        # Send a post request to login.
-        para = {
-            "action": "login",
-            'lgname': self.info["botName"],
-            'lgpassword': self.info["botPassword"],
-            "lgtoken": tokens,
-            "format": "json"
-        }
-        res = self.sess.post(url=self.info["url"], data=para)
+    # downloaded files larger than this are kept on disk instead of memory
+    SPOOL_SIZE = 8 * 1024 * 1024
+    # files larger than this are uploaded in chunks of this size, can be set by "chunkSize" in config (0 = never)
+    CHUNK_SIZE = 4 * 1024 * 1024
+    # api errors meaning a stashed upload cannot be continued
+    STASH_ERRORS = ["stashfailed", "stashnosuchfilekey", "stashfilenotfound", "nofilekey", "missingresult"]
 
-    def logout(self):
-        # GET request to fetch CSRF token
+    def query_recent_upload(self, since):
+        # stream the uploads from the timestamp "since" onwards, oldest first, following "continue"
         para = {
-            "action": "query",
-            "meta": "tokens",
-            "format": "json"
+            'action': 'query',
+            'format': 'json',
+            'list': 'allimages',
+            'aistart': since,
+            'aiprop': 'timestamp|user|comment',
+            'ailimit': 500,
+            'aidir': 'ascending',
+            'aisort': 'timestamp'
         }
-        res = self.sess.get(url=self.info["url"], params=para)
-        data = res.json()
-        csrf_tokens = data['query']['tokens']['csrftoken']
-        # Send a post request to logout.
-        para = {
-            "action": "logout",
-            "token": csrf_tokens,
-        }
-        res = self.sess.get(url=self.info["url"], params=para)
-        self.sess = None
-
-    def query_recent_upload(self, target_date):
-        response = requests.get(
-            self.info["url"],
-            params={
-                'action': 'query',
-                'format': 'json',
-                'list': 'allimages',
-                'aistart': target_date.strftime("%Y-%m-%d") + 'T23:59:00Z', # why inverted?
-                'aiend': target_date.strftime("%Y-%m-%d") + 'T00:00:00Z',    # why inverted?
-                'aiprop': 'title|timestamp|user|comment',
-                'ailimit': 500,
-                'aidir': 'descending',
-                'aisort': 'timestamp'
-            }
-        ).json()        
-        return response['query']['allimages']
+        cont = {}
+        while True:
+            response = self.get("list", {**para, **cont})
+            for en in response['query']['allimages']:
+                yield en
+            if 'continue' not in response:
+                break
+            cont = response['continue']
 
     def query_latest_version(self, file_name):
-        response = requests.get(
-            self.info["url"],
-            params={
+        response = self.get(
+            "fetch",
+            {
                 'action': 'query',
                 'format': 'json',
                 'prop':'imageinfo',
                 'titles': file_name,
-                'iiprop': 'timestamp|user|url|comment'
+                'iiprop': 'timestamp|user|url|comment|sha1|size'
             }
-        ).json()
+        )
         if '-1' in response['query']['pages']:
             return None
         img = next(iter(response['query']['pages'].values()))
         return img['imageinfo'][0]
     
+    def download_file(self, url, file=None):
+        # stream the file into "file", or a temp file (kept in memory only if small)
+        # return the file and its sha1
+        self.throttle(self.read_limit, "download")
+        sha1 = hashlib.sha1()
+        if file is None:
+            file = tempfile.SpooledTemporaryFile(max_size=WikiEditor.SPOOL_SIZE)
+        # same session as the api, the connection to the file server is kept alive as well
+        with self.http("download", "GET", url=url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=65536):
+                sha1.update(chunk)
+                file.write(chunk)
+                metrics.count("bytes_received", self.info["name"], "download", len(chunk))
+        file.seek(0)
+        return file, sha1.hexdigest()
+
     def check_success(self, res, action):
         data = res.json()
         if res.status_code != 200:
@@ -128,33 +105,90 @@ class WikiEditor(object):
             return False, data
         return True, data
 
-    def upload_file(self, title, file, autobot_comment):
-        # GET request to fetch CSRF token
-        para = {
-            "action": "query",
-            "meta": "tokens",
-            "format": "json"
-        }
-        res = self.sess.get(url=self.info["url"], params=para)
-        data = res.json()
-        csrf_tokens = data['query']['tokens']['csrftoken']
-        # POST request to upload image
+    def upload_file(self, title, file, autobot_comment, resume=None, on_chunk=None):
+        # POST request to upload image, in chunks if the file is larger than "chunkSize"
+        chunk_size = self.info.get("chunkSize", WikiEditor.CHUNK_SIZE)
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+        if chunk_size > 0 and size > chunk_size:
+            return self.upload_chunks(title, file, size, chunk_size, autobot_comment, resume, on_chunk)
         para = {
             "action": "upload",
             "filename": title,
-            "token": csrf_tokens,
             "format": "json",
             "ignorewarnings": 1,
             "comment": autobot_comment            
         }
         u_file = {'file':(title, file, 'multipart/form-data')}
-        res = self.sess.post(url=self.info["url"], files=u_file, data=para)
+        res = self.post_with_token("upload", para, u_file)
         # print(res)
         suc, data = self.check_success(res, "upload")
         return suc, res
 
+    def upload_chunks(self, title, file, size, chunk_size, autobot_comment, resume=None, on_chunk=None):
+        # chunked upload: each chunk is read from the file and stashed with "offset" and "filekey",
+        # the file is published by one last request after all chunks are stashed
+        # resume: (filekey, offset) of an interrupted upload, on_chunk(filekey, offset) is called after each chunk
+        filekey, offset = resume if resume is not None else (None, 0)
+        failures = 0
+        while offset < size:
+            file.seek(offset)
+            chunk = file.read(chunk_size)
+            para = {
+                "action": "upload",
+                "filename": title,
+                "format": "json",
+                "filesize": size,
+                "offset": offset,
+                "stash": 1,
+                "ignorewarnings": 1
+            }
+            if filekey is not None:
+                para["filekey"] = filekey
+            res = self.post_with_token("upload", para, {'chunk': (title, io.BytesIO(chunk), 'multipart/form-data')})
+            data = res.json()
+            if data.get("upload", {}).get("result") in ["Continue", "Success"]:
+                filekey = data["upload"]["filekey"]
+                # the last chunk is answered without an offset
+                offset = data["upload"].get("offset", offset + len(chunk))
+                failures = 0
+                metrics.count("chunks", self.info["name"], "upload")
+                if on_chunk is not None:
+                    on_chunk(filekey, offset)
+                continue
+            error = data.get("error", {})
+            # an error with an offset is a chunk offset mismatch, the stash is still there
+            if resume is not None and error.get("code") in WikiEditor.STASH_ERRORS and "offset" not in error:
+                # the stash of the interrupted upload is gone, start again
+                return self.upload_chunks(title, file, size, chunk_size, autobot_comment, None, on_chunk)
+            failures += 1
+            if failures >= 3:
+                return False, res
+            # continue from the offset the wiki has, e.g. the wiki saved the last chunk of a run
+            # that was killed before it got the answer
+            if "offset" in error:
+                offset = int(error["offset"])
+        para = {
+            "action": "upload",
+            "filename": title,
+            "format": "json",
+            "filekey": filekey,
+            "ignorewarnings": 1,
+            "comment": autobot_comment
+        }
+        res = self.post_with_token("upload", para)
+        suc, data = self.check_success(res, "upload")
+        if not suc and resume is not None and data.get("error", {}).get("code") in WikiEditor.STASH_ERRORS:
+            return self.upload_chunks(title, file, size, chunk_size, autobot_comment, None, on_chunk)
+        return suc, res
+
+
+# "sessionFile" in config: save the sessions for the next run
+editor_pool = EditorPool(WikiEditor)
 
-class WikiSync():
+
+class WikiSync(SyncBase):
 
     NON_SYNC_PREFFIX = {
         "首頁":"首頁",
@@ -168,45 +202,79 @@ class WikiSync():
 
     AUTOBOT_COMMENT = "Wiki-Bot 同步更新"
 
-    def __init__ (self, wiki, logger):
-        self.wikis = wiki
-        self.logger = logger
+    # uploads
+    CURSOR_KINDS = ("allimages",)
+
+    def __init__ (self, wiki, logger, workers=SyncEngine.WORKERS, state=None):
+        super().__init__(wiki, logger, workers, state)
+        self.cache = None # BlobCache, source files downloaded before
+
+    def configure(self, data):
+        super().configure(data)
+        self.cache = sync_base.open_cache(data)
 
     def get_recent_upload(self):
-        recent_update = {}
         # note: need to sort the list based on updated date time
+        recent_update = self.list_recent_uploads()
+        lst = [ [ recent_update[key], key ] for key in recent_update ]
+        lst = sorted(lst)        
+        return [ en[1] for en in lst ]
+
+    def list_recent_uploads(self):
+        # { title: timestamp of the latest upload } since the cursors
+        # the cursors are kept only if the whole listing succeeds, otherwise the next call lists the uploads again
+        recent_update = {}
+        cursors = {}
         with open_editor(self.wikis) as editors:            
             for key in editors:
-                lst = editors[key].query_recent_upload(datetime.date.today() + datetime.timedelta(days = -1))
-                for en in lst:
+                # uploads in the same second are listed again, they are skipped by the sync state
+                since, _ = self.recent_cursor(key, "allimages")
+                for en in editors[key].query_recent_upload(since):
+                    cursors[key] = (en["timestamp"], 0)
                     if en["comment"] != WikiSync.AUTOBOT_COMMENT: # ignore auto update
                         if en["title"] not in recent_update:
                             recent_update[en["title"]] = en["timestamp"]
                         else:                            
                             recent_update[en["title"]] = max(en["timestamp"], recent_update[en["title"]])
-        lst = [ [ recent_update[key], key ] for key in recent_update ]
-        lst = sorted(lst)        
-        return [ en[1] for en in lst ]
+        self.cursors["allimages"].update(cursors)
+        return recent_update
     
     def sync_all_images(self, cur_list):
         # print(cur_list)
+        # return the titles that could not be synced to some wiki
+        failed = []
+        def on_error(title, e):
+            self.logger.error("{}同步失敗:{}".format(title, str(e)))
+            self.event(title, None, "sync", "error")
+            failed.append(title)
         with open_editor(self.wikis) as editors:
-            for title in cur_list:                
-                try:
-                    self.sync_image(editors, title)
-                except Exception as e:
-                    self.logger.error("{}同步失敗:{}".format(title, str(e)))
-                time.sleep(1) # wait one second to avoid massive edit
+            # uploads are paced by the rate limit of each wiki
+            def sync(title):
+                with self.measure(title):
+                    synced = self.sync_image(editors, title)
+                # a file with a failed upload stays in the journal for --resume
+                if synced:
+                    self.done(title)
+                else:
+                    failed.append(title)
+            self.engine.run(cur_list, sync, on_error)
+        self.engine.shutdown()
+        return failed
     
     def sync_image(self, editors, title):
+        # return False if the file could not be synced to some wiki, a resumed run tries it again
         # query the latest version gfrom each wiki
-        all_revision = {}
-        for key in editors:
-            rev = editors[key].query_latest_version(title)
-            all_revision[key] = rev
+        all_revision = self.engine.per_wiki(editors, lambda key, editor: editor.query_latest_version(title))
         if len([key for key in all_revision if all_revision[key] is not None]) == 0:
             self.logger.error("錯誤！找不到{}!".format(title))
-            return        
+            self.event(title, None, "query", "not_found")
+            return True
+        # skip without downloading if no wiki has a new version since last sync
+        current = { key: all_revision[key]["timestamp"] if all_revision[key] is not None else None for key in all_revision }
+        if self.state is not None and self.state.is_converged("file", title, current, "timestamp"):
+            self.logger.info("{}經已同步!".format(title))
+            self.event(title, None, "skip", "converged")
+            return True
         # get latest revision
         def func(key):
             if all_revision[key] is None:
@@ -216,53 +284,127 @@ class WikiSync():
         # if the latest update is from wikibot, ignore
         if all_revision[latest_rev]["comment"] == WikiSync.AUTOBOT_COMMENT:
             self.logger.error("{}經已同步".format(title))
-            return
-        # download the files for checking
-        img_file = {}
-        source_file = None
-        for key in editors:
-            if all_revision[key] is None:
-                img_file[key] = ""
-            else:
-                r = requests.get(all_revision[key]["url"])
-                # content = io.BytesIO(r.content)
-                img_file[key] = base64.b64encode(r.content).decode('ascii')
-                if key == latest_rev:
-                    source_file = io.BytesIO(r.content)
-        if source_file is None:
-            self.logger.info("{}同步失敗: file not found".format(title))
-            return        
+            self.event(title, latest_rev, "skip", "synced_by_bot")
+            return True
+        # compare by the sha1 and size reported by each wiki, no need to download every copy
+        source = all_revision[latest_rev]
+        targets = []
+        synced = { latest_rev: { "timestamp": source["timestamp"], "fingerprint": source.get("sha1") } }
         for key in editors:
             if key == latest_rev:
-                continue            
-            if img_file[key] == img_file[latest_rev]:
-                self.logger.info("{}經已同步!".format(title))
                 continue
-            # upload file to target
-            update_suc, res = editors[key].upload_file(title, source_file, WikiSync.AUTOBOT_COMMENT)
-            if update_suc:
-                self.logger.info("{}同步到{}成功!".format(title, key))
+            rev = all_revision[key]
+            if rev is not None and rev.get("sha1") == source.get("sha1") and rev.get("size") == source.get("size"):
+                self.logger.info("{}經已同步!".format(title))
+                self.event(title, key, "upload", "unchanged")
+                synced[key] = { "timestamp": rev["timestamp"], "fingerprint": rev.get("sha1") }
             else:
-                self.logger.info("{}同步到{}失敗: {} {}".format(title, key, res.status_code, res.text))
+                targets.append(key)
+        failed = False
+        if len(targets) > 0:
+            # download the source file only, once for all targets
+            source_file, source_sha1 = self.fetch_source(editors[latest_rev], source)
+            with source_file:
+                if source.get("sha1") is not None and source_sha1 != source.get("sha1"):
+                    self.logger.info("{}同步失敗: sha1 mismatch".format(title))
+                    self.event(title, latest_rev, "download", "failed")
+                    return False
+                size = source.get("size", 0)
+                for key in targets:
+                    # upload file to target, an interrupted chunked upload continues from the last stashed chunk
+                    source_file.seek(0)
+                    resume = None
+                    on_chunk = None
+                    if self.state is not None:
+                        resume = self.state.get_upload(title, key, source_sha1)
+                        on_chunk = lambda filekey, offset, key=key: self.state.set_upload(title, key, source_sha1, filekey, offset)
+                    start = time.monotonic()
+                    update_suc, res = editors[key].upload_file(title, source_file, WikiSync.AUTOBOT_COMMENT, resume, on_chunk)
+                    if update_suc and self.state is not None:
+                        self.state.forget_upload(title, key)
+                    latency = time.monotonic() - start
+                    metrics.observe("phase", self.wikis[key]["name"], "upload", latency)
+                    if update_suc:
+                        self.logger.info("{}同步到{}成功!".format(title, key))
+                        self.event(title, key, "upload", "success", size, latency)
+                        info = res.json()["upload"].get("imageinfo", {})
+                        synced[key] = { "timestamp": info.get("timestamp"), "fingerprint": source_sha1 }
+                    else:
+                        failed = True
+                        self.logger.info("{}同步到{}失敗: {} {}".format(title, key, res.status_code, res.text))
+                        self.event(title, key, "upload", "failed", size, latency)
+        # remember the converged versions, skip the file next time if nothing changed
+        if self.state is not None and not failed:
+            self.state.record("file", title, synced)
+        return not failed
+
+
+    def fetch_source(self, editor, source):
+        # the source file from the blob cache, or downloaded (into the cache)
+        # return the file and its sha1
+        name = editor.info["name"]
+        use_cache = self.cache is not None and source.get("size", 0) <= self.cache.max_size
+        if use_cache and source.get("sha1") is not None:
+            cached = self.cache.open(source["sha1"], source.get("size"))
+            if cached is not None:
+                metrics.count("cache", name, "hit")
+                metrics.count("cache_bytes", name, "hit", source.get("size", 0))
+                return cached, source["sha1"]
+            metrics.count("cache", name, "miss")
+        with metrics.timer("phase", name, "download"):
+            if not use_cache:
+                return editor.download_file(source["url"])
+            tmp = self.cache.create()
+            try:
+                tmp, sha1 = editor.download_file(source["url"], tmp)
+            except Exception:
+                self.cache.discard(tmp)
+                raise
+        # the file is stored by the sha1 of what was downloaded, even if it is not the expected one
+        return self.cache.commit(tmp, sha1), sha1
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sync files between wikis")
+    parser.add_argument("--resume", action="store_true", help="continue the last run if it did not finish")
+    args = parser.parse_args()
+
     logger = logging.getLogger('wiki')
 
     # read config
-    data = {}
-    with open("config.json", "r", encoding="utf-8") as jsonfile:
-        data = json.load(jsonfile)    
-
-    if ("wiki" not in data) or (len(data["wiki"]) == 0):
-        logger.error("設定錯誤: 沒有源頭")
+    data = sync_base.read_config()
+    if data is None:
         quit()
 
-    logger.info("同步: {}".format(str([ data["wiki"][key]["name"] for key in data["wiki"] ])))
-    
-    synchronizer = WikiSync(data["wiki"], logger)
+    state = sync_base.open_state(data)
 
-    logger.info("檢查最近更新檔案")
-    cur_list = synchronizer.get_recent_upload()
+    synchronizer = WikiSync(data["wiki"], logger, data.get("workers", SyncEngine.WORKERS), state)
+    synchronizer.configure(data)
+    sync_base.setup_pool(editor_pool, data)
+
+    # "fileJournal": record of the run for --resume, "" to disable
+    journal = None
+    if data.get("fileJournal", "sync_file.journal"):
+        journal = RunJournal(data.get("fileJournal", "sync_file.journal"))
+    plan = journal.load() if journal is not None and args.resume else None
+
+    if plan is not None:
+        cur_list = synchronizer.resume(plan)
+        logger.info("繼續上次未完成的同步: 尚餘{}個檔案".format(len(cur_list)))
+        journal.resume()
+    else:
+        if args.resume:
+            logger.info("沒有未完成的同步")
+        logger.info("檢查最近更新檔案")
+        cur_list = synchronizer.get_recent_upload()
+        if journal is not None:
+            journal.start(synchronizer.plan(cur_list))
+    synchronizer.journal = journal
 
     synchronizer.sync_all_images(cur_list)
+    synchronizer.save_cursors()
+    editor_pool.close()
+    if journal is not None:
+        journal.finish()
+
+    sync_base.finish(data, state)
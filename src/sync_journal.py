@@ -0,0 +1,83 @@
+import os
+import json
+import threading
+
+
+class RunJournal(object):
+
+    # append-only record of a run, one json object per line:
+    #   { "type": "plan", "titles": [...], ... }  titles to sync and what is needed to finish the run (cursors, moves)
+    #   { "type": "titles", "titles": [...] }     titles added during the run, e.g. redirect targets
+    #   { "type": "event", "title", "wiki", "action", "outcome" }
+    #   { "type": "done", "title" }               all wikis of the title are handled
+    #   { "type": "finish" }
+    # a run without "finish" can be resumed with the titles not "done" yet
+    def __init__ (self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        # return the plan of an unfinished run with "titles" = the titles still to do, or None
+        if not os.path.exists(self.path):
+            return None
+        plan = None
+        titles = []
+        done = set()
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be cut by a crash
+                    continue
+                if entry["type"] == "plan":
+                    plan = entry
+                    titles = list(entry["titles"])
+                    done = set()
+                elif entry["type"] == "titles":
+                    titles += entry["titles"]
+                elif entry["type"] == "done":
+                    done.add(entry["title"])
+                elif entry["type"] == "finish":
+                    plan = None
+        if plan is None:
+            return None
+        seen = set()
+        remaining = []
+        for title in titles:
+            if title not in done and title not in seen:
+                seen.add(title)
+                remaining.append(title)
+        return dict(plan, titles=remaining)
+
+    def start(self, plan):
+        # a new run, the journal of the last run is replaced
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.write(dict(plan, type="plan"))
+
+    def resume(self):
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def write(self, entry):
+        # flushed on every line, a killed run loses at most the line being written
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def add_titles(self, titles):
+        self.write({ "type": "titles", "titles": titles })
+
+    def event(self, title, wiki, action, outcome):
+        self.write({ "type": "event", "title": title, "wiki": wiki, "action": action, "outcome": outcome })
+
+    def done(self, title):
+        self.write({ "type": "done", "title": title })
+
+    def finish(self):
+        self.write({ "type": "finish" })
+        with self.lock:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,70 @@
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+FORMAT = '%(asctime)s: %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# default files for the human readable log and the structured events
+LOG_FILE = "auto_sync.log"
+EVENT_FILE = "sync_events.jsonl"
+
+
+class EventFilter(logging.Filter):
+
+    # pass only the structured events (is_event=True) or only the plain messages
+    def __init__ (self, is_event):
+        super().__init__()
+        self.is_event = is_event
+
+    def filter(self, record):
+        return hasattr(record, "event") == self.is_event
+
+
+class EventFormatter(logging.Formatter):
+
+    # one json object per line
+    def format(self, record):
+        event = { "time": self.formatTime(record, DATE_FORMAT) }
+        event.update(record.event)
+        return json.dumps(event, ensure_ascii=False)
+
+
+def setup_logging(log_file=LOG_FILE, event_file=EVENT_FILE):
+    # the sync threads only put the records in a queue, a background thread writes them
+    # to the log file, the console and (if event_file is set) the jsonl event file
+    plain = [ logging.FileHandler(log_file, encoding = "UTF-8"), logging.StreamHandler() ]
+    formatter = logging.Formatter(FORMAT, datefmt=DATE_FORMAT)
+    for handler in plain:
+        handler.setFormatter(formatter)
+        handler.addFilter(EventFilter(False))
+    handlers = plain
+    if event_file:
+        handler = logging.FileHandler(event_file, encoding = "UTF-8")
+        handler.setFormatter(EventFormatter())
+        handler.addFilter(EventFilter(True))
+        handlers = plain + [handler]
+    records = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(logging.INFO)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def log_event(logger, title, wiki, action, outcome, bytes_sent=0, latency=0.0):
+    # one event per title and target wiki, written to the event file only
+    logger.info("%s %s %s %s", title, wiki, action, outcome, extra={ "event": {
+        "title": title,
+        "wiki": wiki,
+        "action": action,
+        "outcome": outcome,
+        "bytes": bytes_sent,
+        "latency": round(latency, 3)
+    }})
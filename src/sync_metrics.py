@@ -0,0 +1,148 @@
+import os
+import re
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf")]
+
+
+class Metrics(object):
+
+    # counters and latency histograms, labelled by wiki and phase
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.counters = {} # (name, wiki, phase): value
+        self.histograms = {} # (name, wiki, phase): [ bucket counts, sum, count ]
+        self.started = time.time()
+
+    def count(self, name, wiki, phase, value=1):
+        key = (name, wiki or "", phase)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, wiki, phase, seconds):
+        key = (name, wiki or "", phase)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            hist = self.histograms[key]
+            for idx in range(0, len(BUCKETS)):
+                if seconds <= BUCKETS[idx]:
+                    hist[0][idx] += 1
+                    break
+            hist[1] += seconds
+            hist[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, wiki, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, wiki, phase, time.monotonic() - start)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def report(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "counters": [
+                    { "name": key[0], "wiki": key[1], "phase": key[2], "value": value }
+                    for key, value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    { "name": key[0], "wiki": key[1], "phase": key[2], "buckets": list(hist[0]), "sum": hist[1], "count": hist[2] }
+                    for key, hist in sorted(self.histograms.items())
+                ]
+            }
+
+    def summary(self):
+        # lines for the end-of-run log: requests, bytes and time spent per wiki and phase
+        report = self.report()
+        lines = ["執行時間 {:.1f}s".format(report["duration"])]
+        for hist in report["histograms"]:
+            lines.append("{} {} {}: {} 次, 共 {:.2f}s, 平均 {:.3f}s".format(
+                hist["name"], hist["wiki"], hist["phase"], hist["count"], hist["sum"], hist["sum"] / max(1, hist["count"])))
+        for counter in report["counters"]:
+            lines.append("{} {} {}: {}".format(counter["name"], counter["wiki"], counter["phase"], counter["value"]))
+        return lines
+
+    def prometheus(self):
+        report = self.report()
+        out = io.StringIO()
+        def labels(en, extra=""):
+            return '{{wiki="{}",phase="{}"{}}}'.format(en["wiki"], en["phase"], extra)
+        names = set()
+        for counter in report["counters"]:
+            name = "wikisync_" + counter["name"] + "_total"
+            if name not in names:
+                names.add(name)
+                out.write("# TYPE {} counter\n".format(name))
+            out.write("{}{} {}\n".format(name, labels(counter), counter["value"]))
+        for hist in report["histograms"]:
+            name = "wikisync_" + hist["name"] + "_seconds"
+            if name not in names:
+                names.add(name)
+                out.write("# TYPE {} histogram\n".format(name))
+            total = 0
+            for idx in range(0, len(BUCKETS)):
+                total += hist["buckets"][idx]
+                le = "+Inf" if BUCKETS[idx] == float("inf") else str(BUCKETS[idx])
+                out.write('{}_bucket{} {}\n'.format(name, labels(hist, ',le="{}"'.format(le)), total))
+            out.write("{}_sum{} {}\n".format(name, labels(hist), hist["sum"]))
+            out.write("{}_count{} {}\n".format(name, labels(hist), hist["count"]))
+        out.write("# TYPE wikisync_run_duration_seconds gauge\n")
+        out.write("wikisync_run_duration_seconds {}\n".format(report["duration"]))
+        return out.getvalue()
+
+    def write(self, path):
+        # *.prom: prometheus textfile, otherwise json
+        # written to a temp file first, so a collector never reads a half written file
+        if path.endswith(".prom"):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.report(), ensure_ascii=False, indent=2)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+
+# metrics of the whole run
+metrics = Metrics()
+
+
+def profile_path(title):
+    # file name for the profile stats of a title
+    return re.sub(r'[\\/:*?"<>|\s]', "_", title) + ".prof"
+
+
+@contextlib.contextmanager
+def profile(logger, title, path=None):
+    # run the sync of one title under cProfile, log the top functions and optionally dump the stats
+    # note: only the calling thread is profiled, not the parallel reads of each wiki
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        out = io.StringIO()
+        stats = pstats.Stats(prof, stream=out).sort_stats("cumulative")
+        stats.print_stats(20)
+        logger.info("效能分析 {}:\n{}".format(title, out.getvalue()))
+        if path is not None:
+            stats.dump_stats(path)
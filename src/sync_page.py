@@ -1,19 +1,23 @@
-import re
-import json
-import requests
+import heapq
+import argparse
+import itertools
 import contextlib
 import datetime
 import calendar
 import time
 import logging
+import xml.etree.ElementTree as ElementTree
+from sync_engine import SyncEngine, prefetch
+from wiki_transport import WikiClient, EditorPool
+from sync_metrics import metrics
+from sync_state import fingerprint
+from sync_journal import RunJournal
+from sync_base import SyncBase
+import sync_base
+import sync_file
+import wikitext
 
 
-FORMAT = '%(asctime)s: %(message)s'
-logging.basicConfig(format=FORMAT, datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO,  handlers=[
-    logging.FileHandler("auto_sync.log", encoding = "UTF-8"),
-    logging.StreamHandler()
-])
-
 def answer(equation):
     x = 0
     if '+' in equation:
@@ -26,92 +30,322 @@ def answer(equation):
 
 @contextlib.contextmanager
 def open_editor(wikis):
-    editors = { key:WikiEditor(wikis[key]) for key in wikis }
-    for key in editors:
-        editors[key].login()
-    yield editors
-    for key in editors:
-        editors[key].logout()
+    # editors are shared by all phases of the run and login lazily, see editor_pool.close()
+    yield editor_pool.get(wikis)
+
 
+class WikiEditor(WikiClient):
 
-class WikiEditor(object):
+    # max. titles per query, bots with apihighlimits may set "queryLimit" to 500 in config
+    QUERY_LIMIT = 50
+    # pages per request when listing all pages of a wiki
+    SCAN_LIMIT = 500
+    # first stage of a sync: the latest revision without the content, and if the page is a redirect
+    META_PROP = 'ids|timestamp|comment|sha1|size'
+    META_INFO = 'revisions|info'
 
     def __init__ (self, info):
-        self.info = info
-        self.sess = None
-    
-    def login(self):
-        self.sess = requests.Session()
-        # Get Request to fetch login token
+        super().__init__(info)
+        self.namespace_ids = None # { name: id }, see namespaces()
+
+    def query_recent_changes(self, since, rcid=0):
+        # stream the changes from the timestamp "since" onwards, oldest first, following "continue"
+        # changes with rcid <= "rcid" were handled by the last run
         para = {
-            "action": "query",
-            "meta": "tokens",
-            "type": "login",
-            "format": "json"
+            'action': 'query',
+            'format': 'json',
+            'list': 'recentchanges',
+            'rcstart': since,
+            'rcprop': 'title|timestamp|user|comment|ids',
+            'rclimit': 500,
+            'rctype': 'edit|new',
+            'rcdir': 'newer'
         }
-        res = self.sess.get(url=self.info["url"], params=para)
-        data = res.json()
-        tokens = data['query']['tokens']['logintoken']
-        # Send a post request to login.
+        cont = {}
+        while True:
+            response = self.get("list", {**para, **cont})
+            for en in response['query']['recentchanges']:
+                if en['rcid'] > rcid:
+                    yield en
+            if 'continue' not in response:
+                break
+            cont = response['continue']
+
+    def query_moves(self, since, logid=0):
+        # stream the page moves from the timestamp "since" onwards, oldest first, following "continue"
         para = {
-            "action": "login",
-            'lgname': self.info["botName"],
-            'lgpassword': self.info["botPassword"],
-            "lgtoken": tokens,
-            "format": "json"
+            'action': 'query',
+            'format': 'json',
+            'list': 'logevents',
+            'letype': 'move',
+            'lestart': since,
+            'leprop': 'ids|title|timestamp|comment|details',
+            'lelimit': 500,
+            'ledir': 'newer'
         }
-        res = self.sess.post(url=self.info["url"], data=para)
+        cont = {}
+        while True:
+            response = self.get("list", {**para, **cont})
+            for en in response['query']['logevents']:
+                if en['logid'] > logid:
+                    yield en
+            if 'continue' not in response:
+                break
+            cont = response['continue']
 
-    def logout(self):
-        # GET request to fetch CSRF token
+    @staticmethod
+    def sort_key(title):
+        # the order of the titles listed by allpages, the wiki sorts them with "_" instead of " "
+        return title.replace(" ", "_")
+
+    def list_all_pages(self, namespace=0):
+        # stream (title, latest revision without content) of all pages in the namespace, sorted by sort_key()
         para = {
-            "action": "query",
-            "meta": "tokens",
-            "format": "json"
+            'generator': 'allpages',
+            'gapnamespace': namespace,
+            'gaplimit': WikiEditor.SCAN_LIMIT
         }
-        res = self.sess.get(url=self.info["url"], params=para)
-        data = res.json()
-        csrf_tokens = data['query']['tokens']['csrftoken']
-        # Send a post request to logout.
+        for batch in self.generate_pages("scan", para, 'ids|timestamp|comment|sha1', 'revisions'):
+            for title in sorted(batch, key=WikiEditor.sort_key):
+                yield title, batch[title]
+
+    def generate_pages(self, phase, generator, rvprop, prop):
+        # stream { title: latest revision without content } of the pages listed by a generator, one batch per
+        # "gcontinue", with prop=revisions|info the revision of a redirect page is marked with "redirect"
         para = {
-            "action": "logout",
-            "token": csrf_tokens,
+            'action': 'query',
+            'format': 'json',
+            'prop': prop,
+            'rvprop': rvprop,
+            **generator
         }
-        res = self.sess.get(url=self.info["url"], params=para)
-        self.sess = None
+        batch = {}
+        cont = {}
+        while True:
+            response = self.get(phase, {**para, **cont})
+            for page in response.get('query', {}).get('pages', {}).values():
+                if 'revisions' in page:
+                    batch[page['title']] = page['revisions'][0]
+                    if 'redirect' in page:
+                        batch[page['title']]['redirect'] = True
+            # the revisions of a batch of pages may come in several responses
+            if 'batchcomplete' in response or 'continue' not in response:
+                yield batch
+                batch = {}
+            if 'continue' not in response:
+                break
+            cont = response['continue']
 
-    def query_recent_changes(self, target_date):
-        response = requests.get(
-            self.info["url"],
-            params={
+    def namespaces(self):
+        # { local name, canonical name or alias: namespace id } of the wiki, queried once
+        if self.namespace_ids is None:
+            para = {
                 'action': 'query',
                 'format': 'json',
-                'list': 'recentchanges',
-                'rcstart': target_date.strftime("%Y-%m-%d") + 'T23:59:00Z', # why inverted?
-                'rcend': target_date.strftime("%Y-%m-%d") + 'T00:00:00Z',    # why inverted?
-                'rcprop': 'title|timestamp|user|comment',
-                'rclimit': 500,
-                'rctype': 'edit|new',
-                'rcdir': 'older'
+                'meta': 'siteinfo',
+                'siprop': 'namespaces|namespacealiases'
             }
-        ).json()
-        return response['query']['recentchanges']
+            query = self.get("list", para)['query']
+            ids = {}
+            for ns in query.get('namespaces', {}).values():
+                for key in ['*', 'canonical']:
+                    if ns.get(key):
+                        ids[ns[key]] = ns['id']
+            for alias in query.get('namespacealiases', []):
+                ids[alias['*']] = alias['id']
+            self.namespace_ids = ids
+        return self.namespace_ids
+
+    def split_namespace(self, title):
+        # (namespace id, title without the namespace), e.g. "模板:Z" -> (10, "Z")
+        name, sep, rest = title.partition(":")
+        if sep and name in self.namespaces():
+            return self.namespaces()[name], rest
+        return 0, title
+
+    def list_selector(self, kind, value, namespaces):
+        # stream (title, latest revision without content) of the pages matched by a selector of "pages"
+        # in config.json, the pages are listed by a generator with their revisions in the same requests
+        # and only from the given namespaces, except for "prefix" which has its own namespace
+        ns = "|".join(str(namespace) for namespace in namespaces)
+        if kind == "category":
+            if self.split_namespace(value)[0] != 14:
+                value = "Category:" + value
+            para = { 'generator': 'categorymembers', 'gcmtitle': value, 'gcmnamespace': ns, 'gcmlimit': WikiEditor.SCAN_LIMIT }
+        elif kind == "embeddedin":
+            para = { 'generator': 'embeddedin', 'geititle': value, 'geinamespace': ns, 'geilimit': WikiEditor.SCAN_LIMIT }
+        else:
+            namespace, prefix = self.split_namespace(value)
+            para = { 'generator': 'allpages', 'gapprefix': prefix, 'gapnamespace': namespace, 'gaplimit': WikiEditor.SCAN_LIMIT }
+        for batch in self.generate_pages("list", para, WikiEditor.META_PROP, WikiEditor.META_INFO):
+            yield from batch.items()
+
+    def query_page(self, title, rvprop='ids|timestamp|user|content|comment', prop='revisions'):
+        return self.query_pages([title], rvprop, prop)[title]
+
+    def query_pages(self, titles, rvprop='ids|timestamp|user|content|comment', prop='revisions'):
+        # query the latest revision of many pages, up to the api limit of titles per request
+        # return { requested title: revision or None }
+        # with prop=revisions|info, the revision of a redirect page is marked with "redirect"
+        limit = self.info.get("queryLimit", WikiEditor.QUERY_LIMIT)
+        result = {}
+        for idx in range(0, len(titles), limit):
+            result.update(self.query_page_batch(titles[idx:idx+limit], rvprop, prop))
+        return result
 
-    def query_page(self, title):
-        response = requests.get(
-            self.info["url"],
-            params={
+    def query_page_batch(self, titles, rvprop, prop):
+        para = {
+            'action': 'query',
+            'format': 'json',
+            'titles': '|'.join(titles),
+            'prop': prop,
+            'rvprop': rvprop
+        }
+        pages = {}
+        alias = {}
+        cont = {}
+        while True:
+            response = self.get("fetch", {**para, **cont})
+            query = response.get('query', {})
+            # the api may return the title in another form, remember how to map it back
+            for key in ['normalized', 'converted', 'redirects']:
+                for en in query.get(key, []):
+                    alias[en['from']] = en['to']
+            for page in query.get('pages', {}).values():
+                # only a page the wiki says is not there is None, it will be created
+                if 'missing' in page or 'invalid' in page:
+                    pages[page['title']] = None
+                    continue
+                # long pages may be returned in later responses, follow "continue"
+                if 'revisions' in page:
+                    pages[page['title']] = page['revisions'][0]
+                    if 'redirect' in page:
+                        pages[page['title']]['redirect'] = True
+            if 'continue' not in response:
+                break
+            cont = response['continue']
+        result = {}
+        for title in titles:
+            name = title
+            seen = set()
+            while name in alias and name not in seen:
+                seen.add(name)
+                name = alias[name]
+            if name not in pages:
+                raise Exception("{}沒有頁面資料".format(title))
+            result[title] = pages[name]
+        return result
+
+    def export_pages(self, titles):
+        # stream (revid, text) of the latest revisions from Special:Export (action=query&export),
+        # the xml is parsed page by page and each page is cleared after use, so the memory
+        # does not grow with the size of the export
+        para = {
+            'action': 'query',
+            'format': 'json',
+            'titles': '|'.join(titles),
+            'export': 1,
+            'exportnowrap': 1
+        }
+        self.ensure_login()
+        with self.http("export", "GET", limiter=self.read_limit, params=para, stream=True) as res:
+            res.raise_for_status()
+            res.raw.decode_content = True
+            for event, elem in ElementTree.iterparse(res.raw, events=("end",)):
+                if elem.tag.rsplit("}", 1)[-1] != "page":
+                    continue
+                for rev in elem:
+                    if rev.tag.rsplit("}", 1)[-1] != "revision":
+                        continue
+                    revid = None
+                    text = None
+                    for child in rev:
+                        name = child.tag.rsplit("}", 1)[-1]
+                        if name == "id":
+                            revid = int(child.text)
+                        elif name == "text":
+                            text = child.text or ""
+                    if revid is not None and text is not None:
+                        metrics.count("bytes_received", self.info["name"], "export", len(text.encode("utf-8")))
+                        yield revid, text
+                elem.clear()
+
+    def query_dependencies(self, titles):
+        # templates and files used by the pages, up to the api limit of titles per request
+        # the wiki also lists the templates and files used through other templates,
+        # only the template namespace is listed: modules (lua) and other transcluded pages are not wikitext to sync
+        # return (set of template titles, set of file titles)
+        limit = self.info.get("queryLimit", WikiEditor.QUERY_LIMIT)
+        templates = set()
+        files = set()
+        for idx in range(0, len(titles), limit):
+            para = {
                 'action': 'query',
                 'format': 'json',
-                'titles': title,
+                'titles': '|'.join(titles[idx:idx+limit]),
+                'prop': 'templates|images',
+                'tlnamespace': 10,
+                'tllimit': 'max',
+                'imlimit': 'max'
+            }
+            cont = {}
+            while True:
+                response = self.get("list", {**para, **cont})
+                for page in response.get('query', {}).get('pages', {}).values():
+                    templates.update(en['title'] for en in page.get('templates', []) if en['ns'] == 10)
+                    files.update(en['title'] for en in page.get('images', []))
+                if 'continue' not in response:
+                    break
+                cont = response['continue']
+        return templates, files
+
+    def query_redirects(self, titles):
+        # targets of redirect pages resolved by the wiki (redirects=1), up to the api limit of titles per request
+        # return { title: target }, a chain of redirects is resolved one step per title
+        limit = self.info.get("queryLimit", WikiEditor.QUERY_LIMIT)
+        result = {}
+        for idx in range(0, len(titles), limit):
+            para = {
+                'action': 'query',
+                'format': 'json',
+                'titles': '|'.join(titles[idx:idx+limit]),
+                'redirects': 1
+            }
+            response = self.get("list", para)
+            query = response.get('query', {})
+            alias = { en['from']: en['to'] for key in ['normalized', 'converted'] for en in query.get(key, []) }
+            targets = { en['from']: en['to'] for en in query.get('redirects', []) }
+            for title in titles[idx:idx+limit]:
+                name = alias.get(title, title)
+                if name in targets:
+                    result[title] = targets[name]
+        return result
+
+    def query_revisions(self, revids, rvprop='ids|content'):
+        # query revisions by id, for the content of revisions already selected by their metadata
+        # return { revid: revision }, hidden or deleted revisions are left out
+        limit = self.info.get("queryLimit", WikiEditor.QUERY_LIMIT)
+        result = {}
+        for idx in range(0, len(revids), limit):
+            para = {
+                'action': 'query',
+                'format': 'json',
+                'revids': '|'.join(str(revid) for revid in revids[idx:idx+limit]),
                 'prop': 'revisions',
-                'rvprop': 'timestamp|user|content|comment'
+                'rvprop': rvprop
             }
-        ).json()
-        if '-1' in response['query']['pages']:
-            return None
-        page = next(iter(response['query']['pages'].values()))
-        return page['revisions'][0]
+            cont = {}
+            while True:
+                response = self.get("fetch", {**para, **cont})
+                for page in response.get('query', {}).get('pages', {}).values():
+                    for rev in page.get('revisions', []):
+                        if '*' in rev:
+                            result[rev['revid']] = rev
+                # long pages may be returned in later responses, follow "continue"
+                if 'continue' not in response:
+                    break
+                cont = response['continue']
+        return result
     
     def check_success(self, res):
         data = res.json()
@@ -125,43 +359,56 @@ class WikiEditor(object):
             return False, data
         return True, data
         
-    def post_edit(self, title, srcCode, autobot_comment):
-        # GET request to fetch CSRF token
+    def move_page(self, title, new_title, autobot_comment, noredirect=False):
+        # POST request to move a page, the history is kept
         para = {
-            "action": "query",
-            "meta": "tokens",
-            "format": "json"
+            "action": "move",
+            "from": title,
+            "to": new_title,
+            "format": "json",
+            "reason": autobot_comment,
+            "movetalk": True,
+            "watchlist": "unwatch"
         }
-        res = self.sess.get(url=self.info["url"], params=para)
+        if noredirect:
+            para["noredirect"] = True
+        res = self.post_with_token("move", para)
         data = res.json()
-        csrf_tokens = data['query']['tokens']['csrftoken']
-        # POST request to edit a page
+        return res.status_code == 200 and "move" in data, res
+
+    def post_edit(self, title, srcCode, autobot_comment, section=None):
+        # POST request to edit a page, or only the section number "section"
         para = {
             "action": "edit",
             "title": title,
-            "token": csrf_tokens,
             "format": "json",
             "text": srcCode,
             "watchlist": "unwatch",
             "summary": autobot_comment, 
             "bot": True
         }
-        res = self.sess.post(url=self.info["url"], data=para)
+        if section is not None:
+            para["section"] = section
+        res = self.post_with_token("edit", para)
         # check if captcha is needed
         suc, data = self.check_success(res)
         if not suc:
-            if "captcha" in data["edit"]:
+            if "edit" in data and "captcha" in data["edit"]:
                 captcha_id = data["edit"]["captcha"]["id"]
                 captcha_q = data["edit"]["captcha"]["question"]
                 ans = answer(captcha_q)
                 para["captchaword"] = str(ans)
                 para["captchaid"] = captcha_id
-                res = self.sess.post(url=self.info["url"], data=para)
+                res = self.post_with_token("captcha", para)
                 suc, data = self.check_success(res)
         return suc, res
 
 
-class WikiSync():
+# "sessionFile" in config: save the sessions for the next run
+editor_pool = EditorPool(WikiEditor)
+
+
+class WikiSync(SyncBase):
 
     NON_SYNC_PREFFIX = {
         "首頁":"首頁",
@@ -175,115 +422,557 @@ class WikiSync():
 
     AUTOBOT_COMMENT = "Wiki-Bot 同步更新"
 
-    def __init__ (self, wiki, logger):
-        self.wikis = wiki
-        self.logger = logger
-        self.hidden_pages = [] # for redirect pages
+    # seconds to remember the pages moved by the bot, for select_latest()
+    MOVED_MAX_AGE = 24 * 3600
+
+    # selectors in "pages": "category:X", "prefix:Y", "embeddedin:Template:Z"
+    SELECTORS = ("category", "prefix", "embeddedin")
+    # namespaces listed by "category" and "embeddedin": main, template and category pages
+    SELECTOR_NAMESPACES = [0, 10, 14]
+
+    # recent changes and page moves
+    CURSOR_KINDS = ("recentchanges", "logevents")
+
+    def __init__ (self, wiki, logger, workers=SyncEngine.WORKERS, state=None):
+        super().__init__(wiki, logger, workers, state)
+        self.redirects = {} # redirect graph of the run: title -> { targets on any wiki }
+        self.moves = [] # page moves to replay on the other wikis
+        self.moved = {} # (wiki, title): time of the original move, for pages moved by the bot
+        self.section_edit_size = 0 # pages of at least this many bytes are edited by section, 0 = always in full
+        self.backfill = False # stream the content from Special:Export instead of the api
+
+    def configure(self, data):
+        super().configure(data)
+        self.section_edit_size = data.get("sectionEditSize", 0)
 
     def get_recent_change(self):
-        recent_update = {}
         # note: need to sort the list based on updated date time
+        recent_update = self.list_recent_changes()
+        lst = [ [ recent_update[key], key ] for key in recent_update ]
+        lst = sorted(lst)
+        return [ en[1] for en in lst ]
+
+    def list_recent_changes(self):
+        # { title: timestamp of the latest change } since the cursors, page moves are queued in self.moves
+        # the cursors and moves are kept only if the whole listing succeeds, otherwise the next call lists them again
+        recent_update = {}
+        cursors = { kind: {} for kind in WikiSync.CURSOR_KINDS }
+        moves = []
         with open_editor(self.wikis) as editors:
             for key in editors:
-                # print(key) 
-                lst = editors[key].query_recent_changes(datetime.date.today() + datetime.timedelta(days = -1))
-                for en in lst:
+                since, rcid = self.recent_cursor(key, "recentchanges")
+                for en in editors[key].query_recent_changes(since, rcid):
+                    cursors["recentchanges"][key] = (en["timestamp"], en["rcid"])
                     if en["comment"] != WikiSync.AUTOBOT_COMMENT: # ignore auto update
                         if en["title"] not in recent_update:
                             recent_update[en["title"]] = en["timestamp"]
                         else:
                             recent_update[en["title"]] = max(en["timestamp"], recent_update[en["title"]])
-        lst = [ [ recent_update[key], key ] for key in recent_update ]
-        lst = sorted(lst)
-        return [ en[1] for en in lst ]
+                # page moves in the same window, both titles are synced after the move is replayed
+                since, logid = self.recent_cursor(key, "logevents")
+                for en in editors[key].query_moves(since, logid):
+                    cursors["logevents"][key] = (en["timestamp"], en["logid"])
+                    move = self.parse_move(key, en)
+                    if move is None:
+                        continue
+                    moves.append(move)
+                    for title in [move["from"], move["to"]]:
+                        recent_update[title] = max(en["timestamp"], recent_update.get(title, en["timestamp"]))
+        for kind in cursors:
+            self.cursors[kind].update(cursors[kind])
+        self.moves = sorted(self.moves + moves, key=lambda move: move["timestamp"])
+        return recent_update
     
-    def sync_all_pages(self, cur_list):
+    def parse_move(self, key, en):
+        # ignore moves by the bot itself
+        if en.get("comment") == WikiSync.AUTOBOT_COMMENT:
+            return None
+        params = en.get("params", en.get("move", {}))
+        new_title = params.get("target_title", params.get("new_title"))
+        if new_title is None:
+            return None
+        return {
+            "wiki": key,
+            "from": en["title"],
+            "to": new_title,
+            "timestamp": en["timestamp"],
+            "noredirect": "suppressredirect" in params or "suppressedredirect" in params
+        }
+
+    def scan_divergence(self, namespace=0):
+        # merge-join the sorted page listings of all wikis, without downloading any content
+        # return the titles missing on a wiki or differing since the last sync
+        def tagged(key, pages):
+            for title, rev in pages:
+                yield WikiEditor.sort_key(title), key, title, rev
+        result = []
+        count = 0
+        with open_editor(self.wikis) as editors:
+            listings = [ tagged(key, prefetch(editors[key].list_all_pages(namespace))) for key in editors ]
+            for sort_key, group in itertools.groupby(heapq.merge(*listings), key=lambda en: en[0]):
+                group = list(group)
+                title = group[0][2]
+                all_revision = { key: None for key in editors }
+                all_revision.update({ en[1]: en[3] for en in group })
+                count += 1
+                if self.is_divergent(title, all_revision):
+                    result.append(title)
+        metrics.count("scanned", None, "scan", count)
+        self.logger.info("已檢查{}個頁面，{}個頁面需要同步".format(count, len(result)))
+        return result
+
+    def is_divergent(self, title, all_revision):
+        # same rules as sync_page, by the metadata only
+        if any(all_revision[key] is None for key in all_revision):
+            return True
+        if len(set(all_revision[key].get("sha1") for key in all_revision)) == 1:
+            return False
+        current = { key: all_revision[key]["revid"] for key in all_revision }
+        if self.state is not None and self.state.is_converged("page", title, current):
+            return False
+        return all_revision[self.select_latest(title, all_revision)]["comment"] != WikiSync.AUTOBOT_COMMENT
+
+    def sync_moves(self, editors, moves):
+        # replay the moves on the other wikis, in the order they happened
+        # old moves are forgotten, a watch daemon runs for a long time
+        limit = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - WikiSync.MOVED_MAX_AGE))
+        self.moved = { page: ts for page, ts in self.moved.items() if ts >= limit }
+        for move in moves:
+            if WikiSync.non_sync_reason(move["from"]) is not None or WikiSync.non_sync_reason(move["to"]) is not None:
+                continue
+            for key in editors:
+                if key == move["wiki"]:
+                    continue
+                try:
+                    pages = editors[key].query_pages([move["from"], move["to"]], 'ids|timestamp')
+                    # move only if the old page is there and the new title is still free
+                    if pages[move["from"]] is None or pages[move["to"]] is not None:
+                        self.event(move["from"], key, "move", "skipped")
+                        continue
+                    update_suc, res = editors[key].move_page(move["from"], move["to"], WikiSync.AUTOBOT_COMMENT, move["noredirect"])
+                except Exception as e:
+                    self.logger.error("頁面{}移動到{}失敗:{}".format(move["from"], move["to"], str(e)))
+                    self.event(move["from"], key, "move", "error")
+                    continue
+                if update_suc:
+                    # the move adds a new revision, it should not count as a newer edit
+                    self.moved[(key, move["from"])] = move["timestamp"]
+                    self.moved[(key, move["to"])] = move["timestamp"]
+                    self.logger.info("頁面{}在{}移動到{}成功!".format(move["from"], key, move["to"]))
+                    self.event(move["from"], key, "move", "success")
+                else:
+                    self.logger.info("頁面{}在{}移動到{}失敗: {} {}".format(move["from"], key, move["to"], res.status_code, res.text))
+                    self.event(move["from"], key, "move", "failed")
+
+    @staticmethod
+    def non_sync_reason(title):
+        # return the kind of page if the title cannot be synced, otherwise None
+        for prefix in WikiSync.NON_SYNC_PREFFIX:
+            if title.startswith(prefix):
+                return WikiSync.NON_SYNC_PREFFIX[prefix]
+        return None
+
+    @staticmethod
+    def parse_selector(entry):
+        # (kind, value) of a selector in "pages", or None for a page title
+        # (titles on the wiki start with a capital letter, "category:" cannot be one)
+        kind, sep, value = entry.partition(":")
+        if sep and kind in WikiSync.SELECTORS and value:
+            return kind, value
+        return None
+
+    def select_pages(self, entries, namespaces=SELECTOR_NAMESPACES):
+        # replace the selectors in "pages" by the pages they match on any wiki, without duplicates
+        # return (titles, { wiki: { title: latest revision } }) with the metadata listed by the selectors
+        titles = []
+        seen = set()
+        known = { key: {} for key in self.wikis }
+        with open_editor(self.wikis) as editors:
+            for entry in entries:
+                selector = WikiSync.parse_selector(entry)
+                if selector is None:
+                    found = [entry]
+                else:
+                    listed = self.engine.per_wiki(editors, lambda key, editor: list(editor.list_selector(*selector, namespaces)))
+                    found = []
+                    for key in listed:
+                        for title, rev in listed[key]:
+                            known[key][title] = rev
+                            found.append(title)
+                    self.logger.info("{}: {}個頁面".format(entry, len(set(found))))
+                for title in found:
+                    if title not in seen:
+                        seen.add(title)
+                        titles.append(title)
+        return titles, known
+
+    def dependencies(self, titles):
+        # templates and files used by the pages on any wiki, and by those templates, each title queried once
+        # return (templates not in titles, files), the sync templates of the bot are left out
+        seen = set(titles)
+        templates = []
+        files = set()
+        todo = list(titles)
+        with open_editor(self.wikis) as editors:
+            while len(todo) > 0:
+                found = self.engine.per_wiki(editors, lambda key, editor: editor.query_dependencies(todo))
+                todo = []
+                for key in found:
+                    files.update(found[key][1])
+                    for title in sorted(found[key][0]):
+                        if title not in seen and WikiSync.non_sync_reason(title) is None:
+                            seen.add(title)
+                            templates.append(title)
+                            todo.append(title)
+        return templates, sorted(files)
+
+    def query_meta(self, editor, titles, known=None):
+        # metadata of the titles for the first stage of a sync, titles listed by a selector are not queried again
+        # the revisions are taken out of "known", the content added to them is freed with the batch
+        known = known if known is not None else {}
+        result = { title: known.pop(title) for title in titles if title in known }
+        missing = [ title for title in titles if title not in result ]
+        if len(missing) > 0:
+            result.update(editor.query_pages(missing, WikiEditor.META_PROP, WikiEditor.META_INFO))
+        return result
+
+    def sync_all_pages(self, cur_list, known=None):
+        # known: { wiki: { title: latest revision } } from select_pages()
+        # return the titles that could not be synced to some wiki
+        failed = []
+        def on_error(title, e):
+            self.logger.error("頁面{}同步失敗:{}".format(title, str(e)))
+            self.event(title, None, "sync", "error")
+            failed.append(title)
+        # each title is synced at most once, redirect targets are added to the end of the list,
+        # the graph is for this call only, a watch daemon calls it again for every cycle
+        titles = []
+        scheduled = set()
+        for title in cur_list:
+            if title not in scheduled:
+                scheduled.add(title)
+                titles.append(title)
+        self.redirects = {}
         with open_editor(self.wikis) as editors:
-            for title in cur_list:
+            # replay page moves first, so the content sync only fixes the text if it also differs
+            moves, self.moves = self.moves, []
+            self.sync_moves(editors, moves)
+            limit = min([ editors[key].info.get("queryLimit", WikiEditor.QUERY_LIMIT) for key in editors ])
+            idx = 0
+            while idx < len(titles):
+                batch = titles[idx:idx+limit]
+                # redirect targets found in this batch come after it
+                idx += len(batch)
+                # prefetch the metadata of the whole batch from all wikis at once,
+                # then the content of only the revisions needed to sync
                 try:
-                    self.sync_page(editors, title)
+                    prefetched, batch = self.prepare_batch(editors, batch, known, titles, scheduled)
                 except Exception as e:
-                    self.logger.error("頁面{}同步失敗:{}".format(title, str(e)))
-                time.sleep(1) # wait one second to avoid massive edit
-            hidden_list = self.hidden_pages
-            for title in hidden_list:
+                    self.logger.error("頁面批次讀取失敗:{}".format(str(e)))
+                    # the same steps one title at a time, only the titles that fail are left out
+                    prefetched = { key: {} for key in editors }
+                    ready = []
+                    for title in batch:
+                        try:
+                            found, group = self.prepare_batch(editors, [title], known, titles, scheduled)
+                        except Exception as e:
+                            on_error(title, e)
+                            continue
+                        for key in editors:
+                            prefetched[key].update(found[key])
+                        ready += group
+                    batch = ready
                 try:
-                    self.sync_page(editors, title)
+                    if self.backfill:
+                        # each title is synced as soon as its content is parsed from the export
+                        batch = self.export_content(editors, { title: { key: prefetched[key][title] for key in editors } for title in batch })
+                    else:
+                        self.fetch_content(editors, { title: { key: prefetched[key][title] for key in editors } for title in batch })
                 except Exception as e:
-                    self.logger.error("頁面{}同步失敗:{}".format(title, str(e)))
-                time.sleep(1) # wait one second to avoid massive edit
+                    # sync_page() fetches the content of each title itself
+                    self.logger.error("頁面批次讀取失敗:{}".format(str(e)))
+                def sync(title):
+                    with self.measure(title):
+                        synced = self.sync_page(editors, title, { key: prefetched[key][title] for key in editors })
+                    # a page with a failed edit stays in the journal for --resume
+                    if synced:
+                        self.done(title)
+                    else:
+                        failed.append(title)
+                # edits are paced by the rate limit of each wiki
+                self.engine.run(batch, sync, on_error)
+        self.engine.shutdown()
+        return failed
+
+    def prepare_batch(self, editors, batch, known, titles, scheduled):
+        # metadata of the batch from all wikis, without the converged titles and with the redirect targets scheduled
+        # return (metadata { wiki: { title: revision } }, titles to sync)
+        prefetched = self.engine.per_wiki(editors,
+            lambda key, editor: self.query_meta(editor, batch, known.get(key) if known else None))
+        batch = self.skip_converged(editors, batch, prefetched)
+        self.schedule_redirects(editors, batch, prefetched, titles, scheduled)
+        return prefetched, batch
+
+    def schedule_redirects(self, editors, batch, prefetched, titles, scheduled):
+        # add the targets of the redirect pages in the batch to "titles", with one batched query per wiki,
+        # a target already scheduled (in the list, earlier in the chain or in a cycle) is not added again
+        redirects = { key: [ title for title in batch if prefetched[key][title] is not None and prefetched[key][title].get("redirect") ]
+            for key in editors }
+        redirects = { key: redirects[key] for key in redirects if len(redirects[key]) > 0 }
+        if len(redirects) == 0:
+            return
+        found = self.engine.per_wiki({ key: editors[key] for key in redirects },
+            lambda key, editor: editor.query_redirects(redirects[key]))
+        # the same redirect on several wikis is one edge of the graph, a title may point elsewhere on another wiki
+        merged = {}
+        for key in found:
+            for title, target in found[key].items():
+                merged.setdefault(title, set()).add(target)
+        added = []
+        for title in merged:
+            for target in sorted(merged[title]):
+                if self.is_redirect_cycle(title, target):
+                    self.logger.error("頁面{}的重新導向形成循環: {}".format(title, target))
+                    continue
+                self.redirects.setdefault(title, set()).add(target)
+                if target not in scheduled and WikiSync.non_sync_reason(target) is None:
+                    scheduled.add(target)
+                    titles.append(target)
+                    added.append(target)
+        if len(added) > 0 and self.journal is not None:
+            self.journal.add_titles(added)
+
+    def is_redirect_cycle(self, title, target):
+        # True if the target leads back to the title through the redirects found so far
+        seen = set()
+        todo = [target]
+        while len(todo) > 0:
+            name = todo.pop()
+            if name == title:
+                return True
+            if name not in seen:
+                seen.add(name)
+                todo.extend(self.redirects.get(name, ()))
+        return False
+
+    def skip_converged(self, editors, titles, latest):
+        # compare the latest revid of all wikis with the last sync, without downloading the content
+        if self.state is None:
+            return titles
+        result = []
+        for title in titles:
+            current = { key: latest[key][title]["revid"] if latest[key][title] is not None else None for key in editors }
+            if self.state.is_converged("page", title, current):
+                self.logger.info("頁面{}經已同步".format(title))
+                self.event(title, None, "skip", "converged")
+                self.done(title)
+            else:
+                result.append(title)
+        return result
+
+    def plan(self, titles):
+        # the page moves not replayed yet are also needed
+        return dict(super().plan(titles), moves=self.moves)
+
+    def resume(self, plan):
+        self.moves = plan.get("moves", [])
+        return super().resume(plan)
+
+    def select_latest(self, title, all_revision):
+        # the wiki with the latest revision, a move replayed by the bot keeps the time of the original move
+        def func(key):
+            if all_revision[key] is None:
+                return "1900-01-01T00:00:00Z"
+            return self.moved.get((key, title), all_revision[key]['timestamp'])
+        return max(all_revision, key=func)
+
+    def content_needed(self, title, all_revision):
+        # wikis whose content must be downloaded to sync the page, decided by the metadata only:
+        # none if the latest edit is from the bot or all copies have the same sha1,
+        # otherwise the latest revision and the targets with a different sha1
+        if len([key for key in all_revision if all_revision[key] is not None]) == 0:
+            return []
+        latest_rev = self.select_latest(title, all_revision)
+        source = all_revision[latest_rev]
+        if source["comment"] == WikiSync.AUTOBOT_COMMENT:
+            return []
+        differ = [ key for key in all_revision if key != latest_rev and (all_revision[key] is None
+            or source.get("sha1") is None or all_revision[key].get("sha1") != source["sha1"]) ]
+        if len(differ) == 0:
+            return []
+        return [latest_rev] + [ key for key in differ if all_revision[key] is not None ]
+
+    def fetch_content(self, editors, all_revisions):
+        # all_revisions: { title: { wiki: revision or None } }
+        # add the content ("*") to the revisions needed, with one batched query per wiki
+        needed = {}
+        for title in all_revisions:
+            for key in self.content_needed(title, all_revisions[title]):
+                if "*" not in all_revisions[title][key]:
+                    needed.setdefault(key, []).append(all_revisions[title][key])
+        if len(needed) == 0:
+            return
+        contents = self.engine.per_wiki({ key: editors[key] for key in needed },
+            lambda key, editor: editor.query_revisions([ rev["revid"] for rev in needed[key] ]))
+        for key in needed:
+            for rev in needed[key]:
+                if rev["revid"] in contents[key]:
+                    rev["*"] = contents[key][rev["revid"]]["*"]
+
+    def export_content(self, editors, all_revisions):
+        # like fetch_content(), but streamed from Special:Export of each wiki,
+        # yield each title as soon as all the content it needs is there
+        pending = {} # title: revisions still without content
+        wanted = {} # wiki: { revid: (title, revision) }
+        for title in all_revisions:
+            for key in self.content_needed(title, all_revisions[title]):
+                rev = all_revisions[title][key]
+                if "*" not in rev:
+                    wanted.setdefault(key, {})[rev["revid"]] = (title, rev)
+                    pending[title] = pending.get(title, 0) + 1
+            if pending.get(title, 0) == 0:
+                yield title
+        try:
+            for key in wanted:
+                for revid, text in editors[key].export_pages([ title for title, rev in wanted[key].values() ]):
+                    if revid not in wanted[key]:
+                        continue
+                    title, rev = wanted[key].pop(revid)
+                    rev["*"] = text
+                    pending[title] -= 1
+                    if pending[title] == 0:
+                        yield title
+        except Exception as e:
+            self.logger.error("頁面匯出失敗:{}".format(str(e)))
+        # edited since the metadata was read or the export failed, sync_page fetches the content itself
+        for title in pending:
+            if pending[title] > 0:
+                yield title
+
+    def revision_state(self, rev, content=None):
+        # the sha1 from the api is the fingerprint of the content, no need to download it
+        if content is None:
+            content = rev.get("*")
+        return {
+            "revid": rev.get("revid"),
+            "timestamp": rev.get("timestamp"),
+            "fingerprint": fingerprint(content) if content is not None else rev.get("sha1")
+        }
 
     # sync page:
     # 1) check latest revision of all wiki site
     # 2) compare update time stamp, select the one with latest timestamp and longest text
     # 3) update all sites using the one with latest timestamp 
-    def sync_page(self, editors, title):
+    def sync_page(self, editors, title, all_revision=None):
         # user = page['revisions'][0]['user']
         # ts = page['revisions'][0]['timestamp']
         # comment = page['revisions'][0]['comment']
         # wikicode = page['revisions'][0]['*']
-        all_revision = {}
-        for key in editors:
-            all_revision[key] = editors[key].query_page(title)
+        # all_revision: metadata prefetched by query_pages, query each wiki if not given
+        # return False if the page could not be synced to some wiki, a resumed run tries it again
+        if all_revision is None:
+            all_revision = self.engine.per_wiki(editors,
+                lambda key, editor: editor.query_page(title, WikiEditor.META_PROP, WikiEditor.META_INFO))
         if len([key for key in all_revision if all_revision[key] is not None]) == 0:
             self.logger.error("錯誤！找不到頁面{}!".format(title))
-            return
+            self.event(title, None, "query", "not_found")
+            return True
         # get latest revision
-        def func(key):
-            if all_revision[key] is None:
-                return "1900-01-01T00:00:00Z"
-            return all_revision[key]['timestamp']
-        latest_rev = max(all_revision, key=func)
+        latest_rev = self.select_latest(title, all_revision)
         # if the latest update is from wikibot, ignore
         if all_revision[latest_rev]["comment"] == WikiSync.AUTOBOT_COMMENT:
             self.logger.error("頁面{}經已同步".format(title))
-            return
-        wikicode = all_revision[latest_rev]['*']
-        # for redirect page, need to syn the target page as well
-        if wikicode.startswith("#重新導向") or wikicode.startswith("#REDIRECT") or wikicode.startswith("#重定向"):
-            extract_regex = r"\[\[(.+)\]\]"
-            result = re.search(extract_regex, wikicode)
-            if result is not None:
-                new_title = result.group(1)
-                self.hidden_pages.append(new_title)
-        # edit source
-        wikicode = self.edit_src(wikicode, title)
+            self.event(title, latest_rev, "skip", "synced_by_bot")
+            if self.state is not None and all(all_revision[key] is not None for key in all_revision):
+                self.state.record("page", title, { key: self.revision_state(all_revision[key]) for key in all_revision })
+            return True
+        # download the content only if the sha1 differs (not done yet if not prefetched)
+        needed = self.content_needed(title, all_revision)
+        self.fetch_content(editors, { title: all_revision })
+        for key in needed:
+            if "*" not in all_revision[key]:
+                raise Exception("{}沒有頁面內容".format(self.wikis[key]["name"]))
+        synced = { latest_rev: self.revision_state(all_revision[latest_rev]) }
+        failed = False
+        if len(needed) > 0:
+            wikicode = all_revision[latest_rev]['*']
+            # edit source
+            with metrics.timer("phase", self.wikis[latest_rev]["name"], "transform"):
+                wikicode = self.edit_src(wikicode, title)
+                normalized = wikitext.normalize(wikicode)
         # sync to other wikis
         for key in editors:
             if key == latest_rev:
                 continue
+            if key not in needed and all_revision[key] is not None:
+                # same sha1 as the latest revision
+                self.logger.info("頁面{}同步到{}成功!".format(title, key))
+                self.event(title, key, "edit", "unchanged")
+                synced[key] = self.revision_state(all_revision[key])
+                continue
             if all_revision[key] is None:
-                update_suc, res = editors[key].post_edit(title, wikicode, WikiSync.AUTOBOT_COMMENT)
+                action = "create"
+                newcode = wikicode
             else:
-                self.wikis[key], all_revision[key], all_revision[latest_rev]
-                newcode = self.compare_src({
-                    "src_wiki_name": self.wikis[latest_rev]["name"],
-                    "src_wiki_update": all_revision[latest_rev]["timestamp"],
-                    "target_wiki_content": all_revision[key]["*"],
-                },wikicode, title)
-                if newcode is not None:
-                    update_suc, res = editors[key].post_edit(title, newcode, WikiSync.AUTOBOT_COMMENT)
-                else:
-                    update_suc = True
+                action = "edit"
+                with metrics.timer("phase", self.wikis[key]["name"], "transform"):
+                    newcode = self.compare_src({
+                        "src_wiki_name": self.wikis[latest_rev]["name"],
+                        "src_wiki_update": all_revision[latest_rev]["timestamp"],
+                        "target_wiki_content": all_revision[key]["*"],
+                        "src_wiki_normalized": normalized,
+                    },wikicode, title)
+            if newcode is None:
+                self.logger.info("頁面{}同步到{}成功!".format(title, key))
+                self.event(title, key, action, "unchanged")
+                synced[key] = self.revision_state(all_revision[key])
+                continue
+            edits = None
+            if action == "edit" and 0 < self.section_edit_size <= len(newcode.encode("utf-8")):
+                edits = self.section_edits(newcode, all_revision[key]["*"], title)
+            start = time.monotonic()
+            if edits is None:
+                update_suc, res = editors[key].post_edit(title, newcode, WikiSync.AUTOBOT_COMMENT)
+                size = len(newcode.encode("utf-8"))
+            else:
+                update_suc, res, size, by_section = self.post_sections(editors[key], title, edits, newcode)
+                if not by_section:
+                    edits = None
+            latency = time.monotonic() - start
+            metrics.observe("phase", self.wikis[key]["name"], "edit", latency)
             if update_suc:
+                if edits is not None:
+                    self.logger.info("頁面{}在{}只更新段落{}".format(title, key, [ section for section, text in edits ]))
                 self.logger.info("頁面{}同步到{}成功!".format(title, key))
+                self.event(title, key, action, "success", size, latency)
+                edit = res.json()["edit"]
+                old_rev = all_revision[key] or {}
+                # after a section edit the text is merged by the wiki, its sha1 is not known here
+                synced[key] = self.revision_state({
+                    "revid": edit.get("newrevid", old_rev.get("revid")),
+                    "timestamp": edit.get("newtimestamp", old_rev.get("timestamp"))
+                }, newcode if edits is None else None)
             else:
+                failed = True
                 self.logger.info("頁面{}同步到{}失敗: {} {}".format(title, key, res.status_code, res.text))
+                self.event(title, key, action, "failed", size, latency)
+        # remember the converged revisions, skip the page next time if nothing changed
+        if self.state is not None and not failed:
+            self.state.record("page", title, synced)
+        return not failed
     
     def edit_src(self, srcCode, title):
         # change fandom-table to wikitable
-        srcCode = srcCode.replace("fandom-table", "wikitable")
         # remove {{mirrorpage}} template
         # remove {{synchronized|<wiki name>|<timestamp>}} template
-        srcCode = self.remove_template(srcCode, ["mirrorpage", r"synchro\|[^\}]*"], title.startswith("模板:"))
-        return srcCode
+        return wikitext.clean(srcCode, title.startswith("模板:"))
     
     def compare_src(self, info, newCode, title):
         oldCode = info["target_wiki_content"]
         oldCode = self.edit_src(oldCode, title)
         # remove all space and new lines and check for changes
-        oldCodeRaw = re.sub(r"\n|\s", "", oldCode).lower()
-        newCodeRaw = re.sub(r"\n|\s", "", newCode).lower()
+        oldCodeRaw = wikitext.normalize(oldCode)
+        newCodeRaw = info.get("src_wiki_normalized") or wikitext.normalize(newCode)
         # if it is the same, no need to update
         if newCodeRaw == oldCodeRaw:
            return None
@@ -295,73 +984,160 @@ class WikiSync():
         newtmpl = "{{synchro|" + info["src_wiki_name"] + "|" + dt.strftime("%Y年%m月%d日 %H:%M") + "}}"
         newCode = self.insert_template(newCode, newtmpl, title.startswith("模板:"))
         # replace too many new lines
-        newCode = re.sub(r"\n\n\n[\n]*", "\n\n", newCode)
-        return newCode
+        return wikitext.squeeze_newlines(newCode)
+
+    def section_edits(self, newCode, oldCode, title):
+        # [ (section number, text) ] to send only the sections that differ after edit_src,
+        # or None for a full-page edit: templates, redirects, pages whose headings differ or cannot
+        # be split reliably, and pages where {{synchro}} would end up in another section
+        if title.startswith("模板:") or wikitext.is_redirect(newCode):
+            return None
+        new = wikitext.split_sections(newCode)
+        old = wikitext.split_sections(oldCode)
+        if new is None or old is None or len(new) != len(old):
+            return None
+        for idx in range(1, len(new)):
+            if new[idx][0] != old[idx][0] or wikitext.normalize(new[idx][1]) != wikitext.normalize(old[idx][1]):
+                return None
+        synchro = [ idx for idx in range(0, len(new)) if "{{synchro|" in new[idx][2] ]
+        if len(synchro) != 1:
+            return None
+        for idx in range(0, len(old)):
+            if idx != synchro[0] and "{{synchro|" in old[idx][2]:
+                return None
+        # the section with {{synchro}} is always sent, for the new date
+        changed = [ idx for idx in range(0, len(new)) if idx == synchro[0] or
+            wikitext.normalize(self.edit_src(new[idx][2], title)) != wikitext.normalize(self.edit_src(old[idx][2], title)) ]
+        # a section includes its subsections, a changed subsection is sent with its parent if both changed
+        edits = []
+        covered = 0
+        for idx in changed:
+            if idx < covered:
+                continue
+            end = idx + 1
+            if idx > 0:
+                while end < len(new) and new[end][0] > new[idx][0]:
+                    end += 1
+            edits.append((idx, "".join(section[2] for section in new[idx:end])))
+            covered = end
+        if sum(len(text) for section, text in edits) >= len(newCode):
+            return None
+        return edits
+
+    def post_sections(self, editor, title, edits, newcode):
+        # the headings are the same on both sides, so the section numbers do not change between the edits
+        # return (success, response, bytes sent, True if only the sections were sent)
+        size = 0
+        for idx, (section, text) in enumerate(edits):
+            try:
+                update_suc, res = editor.post_edit(title, text, WikiSync.AUTOBOT_COMMENT, section)
+            except Exception:
+                if idx == 0:
+                    raise
+                update_suc, res = False, None
+            size += len(text.encode("utf-8"))
+            metrics.count("section_edits", editor.info["name"], "edit")
+            if not update_suc:
+                if idx == 0:
+                    return update_suc, res, size, True
+                # the sections saved so far made a bot revision, the next run would take the page as synced,
+                # so the whole page is sent instead of leaving it half-synced
+                self.logger.info("頁面{}在{}段落{}更新失敗，改為更新整個頁面".format(title, editor.info["name"], section))
+                update_suc, res = editor.post_edit(title, newcode, WikiSync.AUTOBOT_COMMENT)
+                return update_suc, res, size + len(newcode.encode("utf-8")), False
+        return update_suc, res, size, True
 
     def remove_template(self, srcCode, templates, is_template):
-        lines = srcCode.split('\n')
-        for idx in range(0, len(lines)):
-            for tm in templates:
-                if is_template:
-                    lines[idx] = re.sub(r"\<noinclude\>\{\{" + tm + r"\}\}\<\/noinclude\>", "", lines[idx])
-                else:
-                    lines[idx] = re.sub(r"\{\{" + tm + r"\}\}", "", lines[idx])
-        return ('\n'.join(lines))
+        return wikitext.get_transform((), tuple(templates), is_template).sub(srcCode)
 
     def insert_template(self, srcCode, template, is_template):
-        if is_template:
-            template = "<noinclude>" + template + "</noinclude>"
-        lines = srcCode.split('\n')
-        # for redirected page, place the template at the bottom, otherwises the wiki will think it is just a normal page
-        if srcCode.startswith("#重新導向") or srcCode.startswith("#REDIRECT") or srcCode.startswith("#重定向"):
-            lines.append(template)
-        else:            
-            found = False
-            for idx in range(0, len(lines)):
-                if lines[idx].lower().find("{{h0") >= 0:
-                    lines.insert(idx+1, template)
-                    found = True
-                    break
-            if not found:
-                lines.insert(0, template)
-        return ('\n'.join(lines))
+        return wikitext.insert_template(srcCode, template, is_template)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sync pages between wikis")
+    parser.add_argument("--resume", action="store_true", help="continue the last run if it did not finish")
+    parser.add_argument("--scan", type=int, nargs="?", const=0, metavar="NAMESPACE",
+        help="compare all pages of the namespace (default 0) on every wiki and sync the ones that differ")
+    parser.add_argument("--backfill", action="store_true", help="read the pages in bulk from Special:Export, e.g. for a new wiki")
+    parser.add_argument("--deps", action="store_true", help="also sync the templates and files used by the pages")
+    args = parser.parse_args()
+
     logger = logging.getLogger('wiki')
 
     # read config
-    data = {}
-    with open("config.json", "r", encoding="utf-8") as jsonfile:
-        data = json.load(jsonfile)    
+    data = sync_base.read_config()
+    if data is None:
+        quit()
 
     if (("pages" in data) and (len(data["pages"]) == 0)):
         logger.error("設定錯誤: 沒有頁面設定")
         quit()
 
-    if ("wiki" not in data) or (len(data["wiki"]) == 0):
-        logger.error("設定錯誤: 沒有源頭")
-        quit()
+    state = sync_base.open_state(data)
 
-    logger.info("同步: {}".format(str([ data["wiki"][key]["name"] for key in data["wiki"] ])))
-    
-    synchronizer = WikiSync(data["wiki"], logger)
+    synchronizer = WikiSync(data["wiki"], logger, data.get("workers", SyncEngine.WORKERS), state)
+    synchronizer.configure(data)
+    synchronizer.backfill = args.backfill
+    sync_base.setup_pool(editor_pool, data)
 
-    if "pages" not in data:
-        logger.info("起動自動化同步模式")
-        cur_list = synchronizer.get_recent_change()
-        data["pages"] = cur_list
+    # "pageJournal": record of the run for --resume, "" to disable
+    journal = None
+    if data.get("pageJournal", "sync_page.journal"):
+        journal = RunJournal(data.get("pageJournal", "sync_page.journal"))
+    plan = journal.load() if journal is not None and args.resume else None
+    known = None
+    files = []
 
-    # remove page not to be sync
-    cur_list = []
-    for en in data["pages"]:
-        can_sync = True
-        for prefix in WikiSync.NON_SYNC_PREFFIX:
-            if en.startswith(prefix):
-                logger.error("錯誤:不能同步{} - {}".format(WikiSync.NON_SYNC_PREFFIX[prefix], en))
-                can_sync = False
-                break
-        if can_sync:
-            cur_list.append(en)
+    if plan is not None:
+        cur_list = synchronizer.resume(plan)
+        # files are not recorded as done, those synced before are skipped by the sync state
+        files = plan.get("files", [])
+        logger.info("繼續上次未完成的同步: 尚餘{}個頁面".format(len(cur_list)))
+        journal.resume()
+    else:
+        if args.resume:
+            logger.info("沒有未完成的同步")
+        if args.scan is not None:
+            logger.info("起動全面檢查模式")
+            data["pages"] = synchronizer.scan_divergence(args.scan)
+        elif "pages" not in data:
+            logger.info("起動自動化同步模式")
+            cur_list = synchronizer.get_recent_change()
+            data["pages"] = cur_list
+        else:
+            # "selectorNamespaces": namespaces listed by the category / embeddedin selectors
+            data["pages"], known = synchronizer.select_pages(data["pages"],
+                data.get("selectorNamespaces", WikiSync.SELECTOR_NAMESPACES))
+
+        # remove page not to be sync
+        cur_list = []
+        for en in data["pages"]:
+            reason = WikiSync.non_sync_reason(en)
+            if reason is not None:
+                logger.error("錯誤:不能同步{} - {}".format(reason, en))
+            else:
+                cur_list.append(en)
+        if args.deps:
+            # templates first, so the pages show correctly as soon as they are synced
+            templates, files = synchronizer.dependencies(cur_list)
+            logger.info("相關模板: {}個，相關檔案: {}個".format(len(templates), len(files)))
+            cur_list = templates + cur_list
+        if journal is not None:
+            journal.start(dict(synchronizer.plan(cur_list), files=files))
+    synchronizer.journal = journal
     
-    synchronizer.sync_all_pages(cur_list)
+    synchronizer.sync_all_pages(cur_list, known)
+    synchronizer.save_cursors()
+    if len(files) > 0:
+        file_sync = sync_file.WikiSync(data["wiki"], logger, data.get("workers", SyncEngine.WORKERS), state)
+        file_sync.configure(data)
+        # the file editors use the sessions of the page editors, no second login
+        sync_file.editor_pool.parent = editor_pool
+        file_sync.sync_all_images(files)
+        sync_file.editor_pool.close()
+    editor_pool.close()
+    if journal is not None:
+        journal.finish()
+
+    sync_base.finish(data, state)
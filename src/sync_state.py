@@ -0,0 +1,152 @@
+import sqlite3
+import hashlib
+import threading
+import time
+
+
+def fingerprint(content):
+    # sha1 of the content, same as the sha1 reported by the wiki api
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha1(content).hexdigest()
+
+
+class SyncState(object):
+
+    # default state file, next to config.json
+    FILE_NAME = "sync_state.db"
+    # entries not updated for this many days are removed by evict()
+    MAX_AGE = 90
+    # seconds an interrupted chunked upload can be resumed, the wiki removes stashed chunks after a while
+    UPLOAD_MAX_AGE = 6 * 3600
+
+    def __init__ (self, path=FILE_NAME):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # one row per (title, wiki, kind), the primary key doubles as the index on title
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                title TEXT NOT NULL,
+                wiki TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                revid INTEGER,
+                timestamp TEXT,
+                fingerprint TEXT,
+                updated INTEGER NOT NULL,
+                PRIMARY KEY (title, wiki, kind)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sync_state_updated ON sync_state (updated)")
+        # high-water mark of the recent changes / uploads listing of each wiki
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_cursor (
+                wiki TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                PRIMARY KEY (wiki, kind)
+            ) WITHOUT ROWID
+        """)
+        # stash key and acknowledged offset of unfinished chunked uploads
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_upload (
+                title TEXT NOT NULL,
+                wiki TEXT NOT NULL,
+                sha1 TEXT NOT NULL,
+                filekey TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                updated INTEGER NOT NULL,
+                PRIMARY KEY (title, wiki)
+            ) WITHOUT ROWID
+        """)
+        self.conn.commit()
+
+    def get(self, kind, title):
+        # return { wiki: { "revid", "timestamp", "fingerprint" } }
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT wiki, revid, timestamp, fingerprint FROM sync_state WHERE title = ? AND kind = ?",
+                (title, kind)
+            ).fetchall()
+        return { row[0]: { "revid": row[1], "timestamp": row[2], "fingerprint": row[3] } for row in rows }
+
+    def record(self, kind, title, revisions):
+        # revisions: { wiki: { "revid", "timestamp", "fingerprint" } } after a successful sync
+        now = int(time.time())
+        rows = [
+            (title, key, kind, rev.get("revid"), rev.get("timestamp"), rev.get("fingerprint"), now)
+            for key, rev in revisions.items()
+        ]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def forget(self, kind, title):
+        with self.lock:
+            self.conn.execute("DELETE FROM sync_state WHERE title = ? AND kind = ?", (title, kind))
+            self.conn.commit()
+
+    def is_converged(self, kind, title, current, field="revid"):
+        # current: { wiki: latest revid (or timestamp for files) }
+        # converged if every wiki still has the revision recorded after the last sync
+        if len(current) == 0 or any(current[key] is None for key in current):
+            return False
+        saved = self.get(kind, title)
+        for key in current:
+            if key not in saved or saved[key][field] != current[key]:
+                return False
+        return True
+
+    def get_cursor(self, wiki, kind):
+        # return (timestamp, id) of the last change handled, or None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT timestamp, id FROM sync_cursor WHERE wiki = ? AND kind = ?", (wiki, kind)
+            ).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def set_cursor(self, wiki, kind, timestamp, id=0):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO sync_cursor VALUES (?, ?, ?, ?)", (wiki, kind, timestamp, id))
+            self.conn.commit()
+
+    def get_upload(self, title, wiki, sha1):
+        # return (filekey, offset) of an unfinished upload of the same file, or None
+        limit = int(time.time()) - SyncState.UPLOAD_MAX_AGE
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT filekey, offset FROM sync_upload WHERE title = ? AND wiki = ? AND sha1 = ? AND updated >= ?",
+                (title, wiki, sha1, limit)
+            ).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def set_upload(self, title, wiki, sha1, filekey, offset):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO sync_upload VALUES (?, ?, ?, ?, ?, ?)",
+                (title, wiki, sha1, filekey, offset, int(time.time())))
+            self.conn.commit()
+
+    def forget_upload(self, title, wiki):
+        with self.lock:
+            self.conn.execute("DELETE FROM sync_upload WHERE title = ? AND wiki = ?", (title, wiki))
+            self.conn.commit()
+
+    def evict(self, max_age=MAX_AGE):
+        # remove stale entries, return number of removed rows
+        limit = int(time.time()) - max_age * 86400
+        with self.lock:
+            cur = self.conn.execute("DELETE FROM sync_state WHERE updated < ?", (limit,))
+            count = cur.rowcount
+            cur = self.conn.execute("DELETE FROM sync_upload WHERE updated < ?", (int(time.time()) - SyncState.UPLOAD_MAX_AGE,))
+            count += cur.rowcount
+            self.conn.commit()
+        return count
+
+    def vacuum(self):
+        with self.lock:
+            self.conn.execute("VACUUM")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
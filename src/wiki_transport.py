@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import random
+import threading
+import email.utils
+import requests
+import requests.adapters
+from sync_engine import RateLimiter
+from sync_metrics import metrics
+
+
+USER_AGENT = "KwikiPageSync/1.0 (https://github.com/DReaperKWiki/KwikiPageSync; User:{}) python-requests/{}"
+# seconds to wait for the connection / for the response, can be set by "connectTimeout" / "readTimeout" in config
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# keep-alive connections kept open per host, can be set by "poolSize" in config
+POOL_SIZE = 10
+# saved sessions older than this (seconds) are not reused, mediawiki sessions usually expire after an hour
+SESSION_MAX_AGE = 3000
+# api requests are refused while the database lag is above this (seconds), can be set by "maxlag" in config
+MAXLAG = 5
+# transient errors are retried this many times, can be set by "retries" in config
+RETRIES = 5
+# exponential backoff: first wait and longest wait in seconds
+BACKOFF = 1
+MAX_BACKOFF = 60
+
+
+def new_session(info):
+    # a session with a keep-alive connection pool per host, gzip and a bot User-Agent
+    sess = requests.Session()
+    size = info.get("poolSize", POOL_SIZE)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    sess.headers.update({
+        "User-Agent": info.get("userAgent") or USER_AGENT.format(info.get("botName", "").split("@")[0], requests.__version__),
+        "Accept-Encoding": "gzip, deflate"
+    })
+    return sess
+
+
+class LoginState(object):
+
+    # login and CSRF token of a session, one object shared by all clients of the session (see share_session),
+    # so a new login or token of one client is seen by the others
+    def __init__ (self):
+        self.csrf_token = None
+        self.token_lock = threading.Lock()
+        self.logged_in = False
+        self.login_lock = threading.RLock()
+        self.generation = 0 # counts the logins, a write that failed with an older session does not login again
+
+
+class WikiClient(object):
+
+    # default requests per second to each wiki, can be set by "readRate" / "editRate" in config
+    READ_RATE = 5
+    EDIT_RATE = 1
+    # api errors meaning the token is no longer valid
+    TOKEN_ERRORS = ["badtoken", "notoken"]
+    # api errors meaning the session has expired, writes are sent with "assert"
+    ASSERT_ERRORS = ["assertuserfailed", "assertbotfailed"]
+    # http status and api errors worth retrying later
+    TRANSIENT_STATUS = [429, 500, 502, 503, 504]
+    TRANSIENT_ERRORS = ["maxlag", "ratelimited", "readonly"]
+
+    # all reads, writes and downloads of a wiki go through one session,
+    # so the connections are reused instead of a new TCP/TLS handshake per request
+    def __init__ (self, info):
+        self.info = info
+        self.sess = new_session(info)
+        self.timeout = (info.get("connectTimeout", CONNECT_TIMEOUT), info.get("readTimeout", READ_TIMEOUT))
+        self.maxlag = info.get("maxlag", MAXLAG)
+        self.retries = info.get("retries", RETRIES)
+        self.read_limit = RateLimiter(info.get("readRate", WikiClient.READ_RATE), info.get("readBurst", 1))
+        self.edit_limit = RateLimiter(info.get("editRate", WikiClient.EDIT_RATE), info.get("editBurst", 1))
+        self.auth = LoginState()
+
+    def http(self, phase, method, url=None, limiter=None, session=None, **kwargs):
+        # every request to the wiki goes through here, paced by "limiter" and counted per wiki and phase
+        # 429, 5xx, maxlag and connection errors are retried with exponential backoff,
+        # the rate of the wiki is halved on each of them and raised again while the wiki is healthy
+        # "session": send with another session than self.sess, e.g. for a new login
+        name = self.info["name"]
+        sess = session or self.sess
+        if url is None and self.maxlag:
+            key = "params" if method == "GET" else "data"
+            kwargs[key] = dict(kwargs.get(key) or {}, maxlag=self.maxlag)
+        for retry in range(0, self.retries + 1):
+            if retry > 0:
+                metrics.count("retries", name, phase)
+            if limiter is not None:
+                self.throttle(limiter, phase)
+            for key in kwargs.get("files") or {}:
+                kwargs["files"][key][1].seek(0)
+            start = time.monotonic()
+            try:
+                res = sess.request(method, url or self.info["url"], timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if retry == self.retries:
+                    raise
+                wait = self.backoff(retry)
+            else:
+                metrics.observe("request", name, phase, time.monotonic() - start)
+                metrics.count("requests", name, phase)
+                metrics.count("bytes_sent", name, phase, len(res.request.url) + len(res.request.body or b""))
+                if not kwargs.get("stream"):
+                    metrics.count("bytes_received", name, phase, len(res.content))
+                wait = self.retry_wait(res, retry)
+                if wait is None:
+                    if limiter is not None:
+                        limiter.speed_up()
+                    return res
+                if retry == self.retries:
+                    return res
+                metrics.count("transient_errors", name, phase)
+            # the whole wiki waits, not only this request
+            for other in [self.read_limit, self.edit_limit]:
+                other.pause(wait)
+            if limiter is not None:
+                limiter.slow_down()
+            else:
+                time.sleep(wait)
+
+    def backoff(self, retry):
+        # exponential backoff with jitter, so the threads do not retry at the same time
+        return min(MAX_BACKOFF, BACKOFF * 2 ** retry) * random.uniform(0.5, 1)
+
+    def retry_wait(self, res, retry):
+        # seconds to wait before retrying, None if the response is not a transient error
+        error = res.headers.get("MediaWiki-API-Error")
+        if res.status_code not in WikiClient.TRANSIENT_STATUS and error not in WikiClient.TRANSIENT_ERRORS:
+            return None
+        wait = self.backoff(retry)
+        hint = res.headers.get("Retry-After")
+        if hint is not None:
+            if hint.strip().isdigit():
+                wait = max(wait, float(hint))
+            else:
+                date = email.utils.parsedate_tz(hint)
+                if date is not None:
+                    wait = max(wait, email.utils.mktime_tz(date) - time.time())
+        elif error == "maxlag" and res.headers.get("X-Database-Lag", "").isdigit():
+            wait = max(wait, float(res.headers["X-Database-Lag"]))
+        return min(wait, MAX_BACKOFF)
+
+    def throttle(self, limiter, phase):
+        # time spent waiting for the rate limit
+        with metrics.timer("throttle", self.info["name"], phase):
+            limiter.acquire()
+
+    def get(self, phase, para):
+        # GET request to the api, paced by the read limit
+        # an error answer (also a maxlag still there after the retries) raises, it must not look like an empty result
+        self.ensure_login()
+        data = self.http(phase, "GET", limiter=self.read_limit, params=para).json()
+        if "error" in data:
+            raise Exception("api error: {} {}".format(data["error"].get("code"), data["error"].get("info", "")))
+        return data
+
+    def ensure_login(self):
+        # login lazily, only once for all phases (or never if the saved session is still valid)
+        with self.auth.login_lock:
+            if not self.auth.logged_in:
+                self.login()
+
+    def login(self, generation=None):
+        # "generation": the session a write failed with, if another thread has logged in since then
+        # the write is only sent again with the new session
+        # the login is done in a new session, the other threads keep the old cookies until it succeeds
+        with self.auth.login_lock:
+            if generation is not None and generation != self.auth.generation:
+                return
+            with new_session(self.info) as sess:
+                # Get Request to fetch login token
+                para = {
+                    "action": "query",
+                    "meta": "tokens",
+                    "type": "login",
+                    "format": "json"
+                }
+                res = self.http("login", "GET", session=sess, params=para)
+                data = res.json()
+                tokens = data['query']['tokens']['logintoken']
+                # Send a post request to login.
+                para = {
+                    "action": "login",
+                    'lgname': self.info["botName"],
+                    'lgpassword': self.info["botPassword"],
+                    "lgtoken": tokens,
+                    "format": "json"
+                }
+                res = self.http("login", "POST", session=sess, data=para)
+                data = res.json()
+                if data.get("login", {}).get("result") != "Success":
+                    raise Exception("login failed: {}".format(res.text))
+                self.sess.cookies.clear()
+                self.sess.cookies.update(sess.cookies)
+            self.auth.csrf_token = None
+            self.auth.logged_in = True
+            self.auth.generation += 1
+
+    def logout(self):
+        # Send a post request to logout.
+        para = {
+            "action": "logout",
+            "token": self.get_csrf_token(),
+        }
+        res = self.http("logout", "GET", params=para)
+        self.sess.cookies.clear()
+        self.auth.csrf_token = None
+        self.auth.logged_in = False
+        self.auth.generation += 1
+
+    def get_csrf_token(self, refresh=False, stale=None):
+        # the CSRF token is valid for the whole session, fetch it once and reuse it for all writes
+        # "stale": the token a write failed with, it is fetched again only if no other thread has done so
+        with self.auth.token_lock:
+            if self.auth.csrf_token is None or (refresh and (stale is None or stale == self.auth.csrf_token)):
+                # GET request to fetch CSRF token
+                para = {
+                    "action": "query",
+                    "meta": "tokens",
+                    "format": "json"
+                }
+                res = self.http("token", "GET", params=para)
+                data = res.json()
+                self.auth.csrf_token = data['query']['tokens']['csrftoken']
+            return self.auth.csrf_token
+
+    def post_with_token(self, phase, para, files=None):
+        # POST with the cached CSRF token, refresh the token on "badtoken",
+        # login again only if the "assert" check says the session has expired
+        self.ensure_login()
+        para["assert"] = self.info.get("assert", "user")
+        for retry in range(0, 3):
+            if retry > 0:
+                metrics.count("retries", self.info["name"], phase)
+            generation = self.auth.generation
+            para["token"] = self.get_csrf_token()
+            res = self.http(phase, "POST", limiter=self.edit_limit, files=files, data=para)
+            data = res.json()
+            code = data["error"].get("code") if "error" in data else None
+            if code in WikiClient.ASSERT_ERRORS:
+                # only the first thread to notice logs in, the others wait for it and use the new session
+                self.login(generation)
+            elif code in WikiClient.TOKEN_ERRORS:
+                self.get_csrf_token(refresh=True, stale=para["token"])
+            else:
+                break
+        return res
+
+    def share_session(self, other):
+        # use the connection, login and rate limits of another client of the same wiki,
+        # e.g. the page editor for the file phase, so the process logs in only once per wiki
+        self.sess.close()
+        self.sess = other.sess
+        self.read_limit = other.read_limit
+        self.edit_limit = other.edit_limit
+        self.auth = other.auth
+
+    def session_key(self):
+        return self.info["url"] + "|" + self.info.get("botName", "")
+
+    def save_session(self):
+        # cookies of the logged in session, to be reused by the next run
+        if not self.auth.logged_in:
+            return None
+        return {
+            "saved": time.time(),
+            "cookies": [ { "name": c.name, "value": c.value, "domain": c.domain, "path": c.path,
+                "expires": c.expires, "secure": c.secure } for c in self.sess.cookies ]
+        }
+
+    def restore_session(self, saved, max_age=SESSION_MAX_AGE):
+        # reuse a saved session if it is not too old, the first write will check it with "assert"
+        now = time.time()
+        if saved is None or now - saved.get("saved", 0) > max_age:
+            return False
+        cookies = [ c for c in saved.get("cookies", []) if c.get("expires") is None or c["expires"] > now ]
+        if len(cookies) == 0:
+            return False
+        for c in cookies:
+            self.sess.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"], expires=c["expires"], secure=c["secure"])
+        self.auth.logged_in = True
+        return True
+
+    def close(self):
+        self.sess.close()
+
+
+class EditorPool(object):
+
+    # one logged in editor per wiki for the whole process, shared by all phases
+    # if session_file is set, the sessions are saved at close() and reused by the next run
+    # if parent is set, the editors share the sessions of the parent pool, which saves or logs them out
+    def __init__ (self, editor_class, session_file=None, max_age=SESSION_MAX_AGE):
+        self.editor_class = editor_class
+        self.session_file = session_file
+        self.max_age = max_age
+        self.parent = None
+        self.editors = {}
+        self.saved = None
+        self.lock = threading.Lock()
+
+    def load_sessions(self):
+        if self.saved is None:
+            self.saved = {}
+            if self.session_file and os.path.exists(self.session_file):
+                try:
+                    with open(self.session_file, "r", encoding="utf-8") as f:
+                        self.saved = json.load(f)
+                except ValueError:
+                    self.saved = {}
+        return self.saved
+
+    def get(self, wikis):
+        with self.lock:
+            for key in wikis:
+                if key not in self.editors:
+                    editor = self.editor_class(wikis[key])
+                    if self.parent is not None:
+                        editor.share_session(self.parent.get({ key: wikis[key] })[key])
+                    else:
+                        editor.restore_session(self.load_sessions().get(editor.session_key()), self.max_age)
+                    self.editors[key] = editor
+            return { key: self.editors[key] for key in wikis }
+
+    def close(self):
+        with self.lock:
+            if self.parent is not None:
+                # the sessions belong to the parent pool, close it after this one
+                self.editors = {}
+                return
+            if self.session_file:
+                sessions = self.load_sessions()
+                for key in self.editors:
+                    saved = self.editors[key].save_session()
+                    if saved is not None:
+                        sessions[self.editors[key].session_key()] = saved
+                # the cookies are credentials, only the owner may read the file
+                tmp = self.session_file + ".tmp"
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(sessions, f)
+                os.replace(tmp, self.session_file)
+            else:
+                for key in self.editors:
+                    if self.editors[key].auth.logged_in:
+                        self.editors[key].logout()
+            for key in self.editors:
+                self.editors[key].close()
+            self.editors = {}
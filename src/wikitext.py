@@ -0,0 +1,107 @@
+import re
+import functools
+
+
+REDIRECT_PREFIX = ("#重新導向", "#REDIRECT", "#重定向")
+
+# change fandom-table to wikitable
+REPLACEMENTS = (("fandom-table", "wikitable"),)
+# {{mirrorpage}} and {{synchro|<wiki name>|<timestamp>}} templates
+SYNC_TEMPLATES = ("mirrorpage", r"synchro\|[^\}\n]*")
+
+MULTI_NEWLINE = re.compile(r"\n\n\n+")
+H0_TEMPLATE = re.compile(r"\{\{h0", re.IGNORECASE)
+# section headings: "== title ==" on its own line, the level is the shorter side
+HEADING = re.compile(r"^(={1,6})(.+?)(={1,6})[ \t]*$", re.MULTILINE)
+HEADING_LIKE = re.compile(r"^=", re.MULTILINE)
+# markup that may hide headings from the wiki, pages with these are not split into sections
+SECTION_UNSAFE = re.compile(r"<(?:!--|nowiki|pre|syntaxhighlight|source|includeonly|noinclude|onlyinclude)", re.IGNORECASE)
+
+
+class WikitextTransform(object):
+
+    # all patterns are compiled into one regex, the text is scanned only once
+    def __init__ (self, replacements, templates, is_template):
+        self.replacements = dict(replacements)
+        tmpl = r"\{\{(?:" + "|".join(templates) + r")\}\}"
+        if is_template:
+            tmpl = r"<noinclude>" + tmpl + r"</noinclude>"
+        parts = [tmpl] if len(templates) > 0 else []
+        parts += [ re.escape(text) for text in self.replacements ]
+        self.pattern = re.compile("|".join(parts)) if len(parts) > 0 else None
+
+    def replace(self, match):
+        # removed templates are not in the replacement table
+        return self.replacements.get(match.group(0), "")
+
+    def sub(self, text):
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self.replace, text)
+
+
+@functools.lru_cache(maxsize=None)
+def get_transform(replacements, templates, is_template):
+    # replacements: ((text, new text), ...), templates: (regex, ...)
+    return WikitextTransform(replacements, templates, is_template)
+
+
+def is_redirect(text):
+    return text.startswith(REDIRECT_PREFIX)
+
+
+def clean(text, is_template):
+    # replace fandom-table and remove sync templates in one pass
+    return get_transform(REPLACEMENTS, SYNC_TEMPLATES, is_template).sub(text)
+
+
+def normalize(text):
+    # remove all space and new lines, for comparing the content
+    return "".join(text.split()).lower()
+
+
+def insert_template(text, template, is_template):
+    if is_template:
+        template = "<noinclude>" + template + "</noinclude>"
+    # for redirected page, place the template at the bottom, otherwises the wiki will think it is just a normal page
+    if is_redirect(text):
+        return text + "\n" + template
+    # place the template after the line with {{h0...}}, or at the top
+    match = H0_TEMPLATE.search(text)
+    if match is None:
+        return template + "\n" + text
+    end = text.find("\n", match.end())
+    if end < 0:
+        return text + "\n" + template
+    return text[:end] + "\n" + template + text[end:]
+
+
+def split_sections(text):
+    # split the text as the wiki numbers the sections: [ (level, heading line, text from the heading on) ],
+    # section 0 is the text before the first heading
+    # return None if the headings cannot be found reliably
+    if SECTION_UNSAFE.search(text) is not None:
+        return None
+    headings = list(HEADING.finditer(text))
+    if len(headings) != len(HEADING_LIKE.findall(text)):
+        return None
+    sections = []
+    start = 0
+    level = 0
+    heading = ""
+    for match in headings:
+        sections.append((level, heading, text[start:match.start()]))
+        start = match.start()
+        level = min(len(match.group(1)), len(match.group(3)))
+        heading = match.group(0)
+    sections.append((level, heading, text[start:]))
+    # a heading inside a template call is not a section of the page
+    for section in sections:
+        if section[2].count("{{") != section[2].count("}}"):
+            return None
+    return sections
+
+
+def squeeze_newlines(text):
+    # replace too many new lines
+    return MULTI_NEWLINE.sub("\n\n", text)